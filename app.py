@@ -1,26 +1,36 @@
 import sys, os
-from flask import Flask, request, abort, jsonify, redirect, url_for, render_template
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import DataError, IntegrityError
-from flask_cors import CORS, cross_origin
-from functools import wraps
-
-from models import setup_db, Movie, Actor, Performance, db, drop_and_init_db
+from flask import Flask, request, jsonify, render_template
+from flask_cors import CORS
+
+from models import setup_db, db, read_only, release_session
+from streaming import stream_listing
+from conditional import conditional
+from response_cache import response_cache
+from rate_limit import rate_limiter
+from metrics import metrics_response, track_requests
+from json_provider import FastJSONProvider
+from seed import seed_command
+from read_model import read_model_cli
 from auth import *
+import views
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
+    app.json = FastJSONProvider(app)
     setup_db(app)
+    response_cache.init_app(app, release=release_session)
+    rate_limiter.init_app(app)
+    track_requests(app)
     CORS(app, resources={r"*": {"origins": "*"}})
     os.environ['FLASK_DEBUG'] = '1'
-
-    #drop_and_init_db(app)
+    app.cli.add_command(seed_command)
+    app.cli.add_command(read_model_cli)
 
     @app.after_request
     def after_request(response):
         response.headers.add(
-            "Access-Control-Allow-Headers", "Content-Type,Authorization,true"
+            "Access-Control-Allow-Headers", "Content-Type,Authorization,If-None-Match,true"
         )
         response.headers.add(
             "Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS,PATCH"
@@ -36,183 +46,99 @@ def create_app(test_config=None):
     @app.route("/")
     def index():
         return render_template('index.html')
+
+
+    @app.route("/metrics")
+    def get_metrics():
+        return metrics_response()
        
 
+    '''
+    stream_response(listing, details_key, total_key)
+    The whole of a listing, ?stream=true, streamed from one query.
+    '''
+    def stream_response(listing, details_key, total_key):
+        response = stream_listing(
+            listing.query(db.session).order_by(listing.key),
+            details_key, total_key, listing.format_row)
+        if response is None:
+            return jsonify(views.NOT_FOUND), 404
+        return response
+
+
 #  Movies
 #  ----------------------------------------------------------------
 
 
     @app.route("/movies")
     @requires_auth('get:movies')
+    @read_only
+    @conditional('movies', 'actors', 'performance')
+    @response_cache.cached('movies', 'castings')
     def get_movies(payload):
+        stream = request.args.get('stream') == 'true'
+        listing = views.movie_listing(request.args, paged=not stream)
+        if stream:
+            return stream_response(listing, 'movie_details', 'total actors')
+
+        body, status_code = views.get_page(
+            db.session, listing, request.args, 'movie_details', 'total actors')
+        return jsonify(body), status_code
 
-        
-        movies_info = []
-        try:
-            movies = db.session.query(Movie).all()
-            if len(movies) == 0:
-                return jsonify({
-                    'success': False,
-                    'message': 'No records were found'
-                }), 404
-            
-            else:
-                for movie in movies:
-                    
-                    #actors = Actor.query.filter(Movie.id == movie.id)
-                                    
-                    movies_info.append({
-                        'actors:': [
-                            {
-                                "actor_id": x.id,
-                                "actor_name": x.name,
-                                "actor_age": x.age,
-                                "actor_gender": x.gender
-                            }
-                            for x in movie.actor
-                        ],
-                        'movie_id': movie.id,
-                        'movie_title': movie.title,
-                        'movie_release_date': movie.release_date.strftime("%B %d %Y %H:%M:%S")
-                    })
-
-            return jsonify({
-                "success": True,
-                "movie_details": movies_info,
-                "total actors": len(movies)
-            }), 200
-        
-        except ValueError as e:
-            
-            db.session.rollback()
-            print(sys.exc_info())
-            abort(422)
+
+    @app.route("/movies/stats")
+    @requires_auth('get:movies')
+    @read_only
+    @conditional('movies', 'performance')
+    @response_cache.cached('movies', 'castings')
+    def get_movie_stats(payload):
+        body, status_code = views.get_movie_stats(db.session, request.args)
+        return jsonify(body), status_code
 
 
     @app.route("/movies/<movie_id>")
     @requires_auth('get:movies')
+    @read_only
+    @conditional('movies', 'actors', 'performance')
+    @response_cache.cached('movie:{movie_id}', 'castings')
     def get_movie(payload, movie_id):
-
-        error = False
-        try:
-            movie = Movie.query.filter(Movie.id == movie_id).first_or_404()
-        
-        except DataError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-        
-        if error:
-            abort(status_code)
-        
-        return jsonify({
-                "success": True,
-                "id": movie.id,
-                "movie": movie.title
-            }), 200
+        body, status_code = views.get_movie(db.session, movie_id, request.args)
+        return jsonify(body), status_code
 
 
     @app.route("/movies", methods=['POST'])
     @requires_auth('post:movies')
     def create_movies(payload):
-        error = False
-        body = {}
-        try:
-            title = request.get_json()['title']
-            release_date = request.get_json()['release_date']
-            movie = Movie(title=title, release_date=release_date)
-            movie.insert()
-            body['id'] = movie.id
-            body['title'] = movie.title
-        
-        except KeyError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-
-        except DataError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-
-        except ValueError:
-            error = True
-            status_code = 500
-            db.session.rollback()
-            print(sys.exc_info())
-        
-        finally:
-            db.session.close()
-        
-        if error:
-            abort(status_code)
-        
-        else:
-            body['success'] = True
-            return jsonify(body), 200
+        body, status_code = views.create_movie(db.session, request.get_json(silent=True))
+        response_cache.invalidate('movies')
+        return jsonify(body), status_code
    
 
+    @app.route("/movies/bulk", methods=['POST'])
+    @requires_auth('post:movies')
+    def create_movies_bulk(payload):
+        body, status_code = views.create_movies_bulk(
+            db.session, request.get_json(silent=True))
+        if status_code == 200:
+            response_cache.invalidate('movies')
+        return jsonify(body), status_code
+
+
     @app.route("/movies/<movie_id>", methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(payload, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-        if movie is None:
-            abort(404)
-        else:
-            movie.delete()
-            return jsonify({
-                "success": True,
-                "movie": movie_id}), 200
+        body, status_code = views.delete_movie(db.session, movie_id)
+        response_cache.invalidate('movies', 'castings', 'movie:%s' % movie_id)
+        return jsonify(body), status_code
 
 
     @app.route("/movies/<movie_id>", methods=['PATCH'])
     @requires_auth('post:movies')
     def patch_movie(payload, movie_id):
-        
-        error = False
-        try:
-            body = request.get_json()
-            new_title = body.get("title", None)
-            new_release_date = body.get('release_date', None)
-            movie = Movie.query.filter(Movie.id == movie_id).first_or_404()
-            if new_title:
-                movie.title = new_title
-            if new_release_date:
-                movie.release_date = new_release_date
-            movie.update()
-        
-        except KeyError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-
-        except DataError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-        
-        except ValueError:
-            error = True
-            status_code = 500
-            db.session.rollback()
-            print(sys.exc_info())
-
-        finally:
-            db.session.close()
-        
-        if error == True:
-            abort(status_code)
-    
-        return jsonify({
-            "success": True,
-            "movie": new_title,
-            "release_date": new_release_date
-        }), 200
+        body, status_code = views.patch_movie(
+            db.session, movie_id, request.get_json(silent=True))
+        response_cache.invalidate('movies', 'castings', 'movie:%s' % movie_id)
+        return jsonify(body), status_code
 
 
 #  Actors
@@ -221,162 +147,73 @@ def create_app(test_config=None):
 
     @app.route("/actors")
     @requires_auth('get:actors')
+    @read_only
+    @conditional('movies', 'actors', 'performance')
+    @response_cache.cached('actors', 'castings')
     def get_actors(payload):
+        stream = request.args.get('stream') == 'true'
+        listing = views.actor_listing(request.args, paged=not stream)
+        if stream:
+            return stream_response(listing, 'actor_details', 'total_actors')
 
-        
-        actors_info = []
-        try:
-            actors = db.session.query(Actor).all()
-            if len(actors) == 0:
-                return jsonify({
-                    'success': False,
-                    'message': 'No records were found'
-                }), 404
-            
-            else:
-                for actor in actors:
-                                    
-                    actors_info.append({
-                        'casting:': [
-                            {
-                                "movie_id": x.id,
-                                "movie_title": x.title,
-                                "movie_release_date": x.release_date.strftime("%B %d %Y %H:%M:%S")
-                            }
-                            for x in actor.movies
-                        ],
-                        'actor_id': actor.id,
-                        'actor_name': actor.name,
-                        'actor_age': actor.age,
-                        'actor_gender': actor.gender
-                    })
-
-            return jsonify({
-                "success": True,
-                "actor_details": actors_info,
-                "total_actors": len(actors)
-            }), 200
-        
-        except ValueError as e:
-            
-            db.session.rollback()
-            print(sys.exc_info())
-            abort(422)
+        body, status_code = views.get_page(
+            db.session, listing, request.args, 'actor_details', 'total_actors')
+        return jsonify(body), status_code
 
 
-    @app.route("/actors/<actor_id>")
+    @app.route("/actors/stats")
     @requires_auth('get:actors')
-    def get_actor(payload, actor_id):
+    @read_only
+    @conditional('movies', 'actors', 'performance')
+    @response_cache.cached('actors', 'castings')
+    def get_actor_stats(payload):
+        body, status_code = views.get_actor_stats(db.session, request.args)
+        return jsonify(body), status_code
 
-        
-        
-        error = False
-        try:
-            actor = Actor.query.filter(Actor.id == actor_id).first_or_404()
-        
-        except ValueError as e:
-            error = True
-            db.session.rollback()
-            print(sys.exc_info())
-        
-        finally:
-            db.session.close()
-        if error:
-            abort(404)
 
-        return jsonify({
-                "success": True,
-                "id": actor.id,
-                "actor": actor.name
-            }), 200
+    @app.route("/actors/<actor_id>")
+    @requires_auth('get:actors')
+    @read_only
+    @conditional('movies', 'actors', 'performance')
+    @response_cache.cached('actor:{actor_id}', 'castings')
+    def get_actor(payload, actor_id):
+        body, status_code = views.get_actor(db.session, actor_id, request.args)
+        return jsonify(body), status_code
 
 
     @app.route("/actors", methods=['POST'])
     @requires_auth('post:actors')
     def create_actor(payload):
-        error = False
-        body = {}
-        try:
-            name = request.get_json()['name']
-            age = request.get_json()['age']
-            gender = request.get_json()['gender']
-            actor = Actor(name=name, age=age, gender=gender)
-            actor.insert()
-            body['id'] = actor.id
-            body['name'] = actor.name
-            print(body)
-
-        except KeyError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-
-        except DataError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-        
-        except ValueError:
-            error = True
-            status_code = 500
-            db.session.rollback()
-            print(sys.exc_info())
-
-        finally:
-            db.session.close()
-        if error:
-            abort(status_code)
-        else:
-            body['success'] = True
-            return jsonify(body), 200
+        body, status_code = views.create_actor(db.session, request.get_json(silent=True))
+        response_cache.invalidate('actors')
+        return jsonify(body), status_code
+
+
+    @app.route("/actors/bulk", methods=['POST'])
+    @requires_auth('post:actors')
+    def create_actors_bulk(payload):
+        body, status_code = views.create_actors_bulk(
+            db.session, request.get_json(silent=True))
+        if status_code == 200:
+            response_cache.invalidate('actors')
+        return jsonify(body), status_code
 
 
     @app.route("/actors/<actor_id>", methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(payload, actor_id):
-
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-        if actor is None:
-            abort(404)
-        else:
-            actor.delete()
-            return jsonify({
-                "success": True,
-                "actor": actor_id
-            }), 200
+        body, status_code = views.delete_actor(db.session, actor_id)
+        response_cache.invalidate('actors', 'castings', 'actor:%s' % actor_id)
+        return jsonify(body), status_code
 
     
     @app.route("/actors/<actor_id>", methods=['PATCH'])
     @requires_auth('post:actors')
     def patch_actor(payload, actor_id):
-
-        body = request.get_json()
-        new_name = body.get("name", None)
-        new_age = body.get("age", None)
-        new_gender = body.get("gender", None)
-        actor = Actor.query.filter(Actor.id == actor_id).first_or_404()
-
-        try:
-            if new_name:
-                actor.name = new_name
-            if new_age:
-                actor.age = new_age
-            if new_gender:
-                actor.gender = new_gender
-            actor.update()
-        
-        except Exception as e:
-            print(e)
-            abort(422)
-    
-        return jsonify({
-            "success": True,
-            "name": actor.name,
-            "age": actor.age,
-            "gender": actor.gender
-        }), 200
+        body, status_code = views.patch_actor(
+            db.session, actor_id, request.get_json(silent=True))
+        response_cache.invalidate('actors', 'castings', 'actor:%s' % actor_id)
+        return jsonify(body), status_code
 
 
 #  Perfermance
@@ -384,101 +221,34 @@ def create_app(test_config=None):
 
     @app.route("/performances")
     @requires_auth('get:performance')
+    @read_only
+    @conditional('movies', 'actors', 'performance')
+    @response_cache.cached('castings')
     def get_perfermance(payload):
-
-        
-        performance_info = []
-        try:
-            performances = db.session.query(Performance).all()
-            if len(performances) == 0:
-                return jsonify({
-                    'success': False,
-                    'message': 'No records were found'
-                }), 404
-            
-            else:
-                for performance in performances:
-                    movie = Movie.query.filter_by(id = performance.movie_id).first()
-                    actor = Actor.query.filter_by(id = performance.actor_id).first()
-                
-                    performance_info.append({
-                        'movie_id': performance.movie_id,
-                        'movie_title': movie.title,
-                        'movie_release_date': movie.release_date.strftime("%B %d %Y %H:%M:%S"),
-                        'actor_id': performance.actor_id,
-                        'actor_name': actor.name,
-                        'actor_age': actor.age,
-                        'actor_gender': actor.gender
-                    })
-
-            return jsonify({
-                "success": True,
-                "performance_details": performance_info,
-                "total_performances": len(performances)
-            }), 200
-        
-        except:
-            abort(422)
+        body, status_code = views.get_page(
+            db.session, views.performance_listing(), request.args,
+            'performance_details', 'total_performances')
+        return jsonify(body), status_code
 
     
     @app.route("/performance", methods=['POST'])
     @requires_auth('post:performance')
     def create_performance(payload):
-        
-        error = False
-        try:
-            actor_id = request.get_json()['actor_id']
-            movie_id = request.get_json()['movie_id']
-
-            performance_exist = db.session.query(Performance).filter_by(actor_id = actor_id, movie_id = movie_id).first()
-            if performance_exist is not None:
-                return jsonify({
-                    "success": False,
-                    "message": "There is a performance with this actor and movie already.",
-                }), 400
-            else:
-                performance = Performance.insert().values(actor_id=actor_id, movie_id=movie_id)
-                db.session.execute(performance)
-                db.session.commit()
-
-        except KeyError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-
-        except DataError:
-            error = True
-            status_code = 400
-            db.session.rollback()
-            print(sys.exc_info())
-
-        except IntegrityError:
-            error = True
-            status_code = 500
-            db.session.rollback()
-            print(sys.exc_info())
-
-        except ValueError:
-            error = True
-            status_code = 500
-            db.session.rollback()
-            print(sys.exc_info())
-
-        finally:
-            db.session.close()
-
-        if error:
-            abort(status_code)
-
-        else:
-            return jsonify({
-                "success": True,
-                "actor_id": actor_id,
-                "movie_id": movie_id
-            }), 200
-
-        
+        body, status_code = views.create_performance(
+            db.session, request.get_json(silent=True))
+        if status_code == 200:
+            response_cache.invalidate('castings')
+        return jsonify(body), status_code
+
+
+    @app.route("/performance/bulk", methods=['POST'])
+    @requires_auth('post:performance')
+    def create_performances_bulk(payload):
+        body, status_code = views.create_performances_bulk(
+            db.session, request.get_json(silent=True))
+        if status_code == 200 and body["total_created"]:
+            response_cache.invalidate('castings')
+        return jsonify(body), status_code
 
 
 #  Error Handling
@@ -532,6 +302,16 @@ def create_app(test_config=None):
             "message": "Method Not Allowed"
         }), 405
 
+    @app.errorhandler(429)
+    def toomanyrequests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "Too Many Requests"
+        })
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+
     @app.errorhandler(500)
     def internalserver(error):
         return jsonify({
@@ -552,7 +332,26 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
+
+'''
+warm_up(app)
+Opens a first connection to the primary and the replica and fetches the
+signing keys, so the first request of a worker does not wait for them.
+gunicorn.conf.py calls it once a worker has loaded the app. Failures are
+logged and left to the first request to retry.
+'''
+def warm_up(app):
+    jwks_store = get_jwks_store()
+    if jwks_store.url and not jwks_store.has_keys:
+        jwks_store.refresh()
+    with app.app_context():
+        for engine in db.engines.values():
+            try:
+                with engine.connect():
+                    pass
+            except Exception:
+                print(sys.exc_info())
+
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -0,0 +1,569 @@
+import asyncio
+import sys
+import time
+from functools import lru_cache, wraps
+from quart import Quart, Response, g, request, abort, jsonify, make_response, render_template
+from quart.json.provider import DefaultJSONProvider
+from quart.wrappers.response import DataBody
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from config import settings
+from models import primary_url, replica_url, get_versions
+from pagination import decode_cursor
+from conditional import make_etag
+from response_cache import response_cache
+from metrics import (metrics_payload, CONTENT_TYPE_LATEST, JWT_VERIFY_SECONDS,
+                     start_request, finish_request, end_request)
+from jwks import AsyncJWKSKeyStore
+from rate_limit import rate_limiter
+from json_provider import FastJSONMixin
+from auth import (AuthError, jwks_options, get_token_cache, parse_auth_header, check_claims,
+                  check_permissions, unverified_kid, decode_jwt)
+import views
+
+
+'''
+Async serving mode
+
+The same routes, payloads and status codes as app.py, served by Quart on
+an ASGI server so that one process keeps many requests in flight while they
+wait on PostgreSQL or on the identity provider:
+
+    uvicorn asgi:create_app --factory --workers 4
+
+The database is reached through SQLAlchemy's asyncio extension on asyncpg.
+The route bodies are the functions of views.py, the same ones app.py
+calls: run_db() runs them against a Session bound to an async connection,
+and run_read() does the same on the read replica. Signing keys come from
+AsyncJWKSKeyStore over httpx.
+
+Conditional GETs and the response cache work as in app.py, on the same
+backend and keys. Cache misses are not coalesced, as SingleFlight waits on
+threads.
+
+The engines and the key store are built on first use. before_serving warms
+them up in every worker, so the first request does not pay for the
+connection and the key fetch.
+'''
+
+'''
+Async engine
+Same pool settings as models.engine_options(). asyncpg takes the statement
+timeout as a server setting instead of a libpq option.
+'''
+def async_database_url(database_path):
+    return database_path.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def async_engine_options():
+    options = {
+        'pool_size': settings.DB_POOL_SIZE,
+        'max_overflow': settings.DB_MAX_OVERFLOW,
+        'pool_timeout': settings.DB_POOL_TIMEOUT,
+        'pool_recycle': settings.DB_POOL_RECYCLE,
+        'pool_pre_ping': settings.DB_POOL_PRE_PING
+    }
+    if settings.DB_STATEMENT_TIMEOUT_MS:
+        options['connect_args'] = {
+            'server_settings': {
+                'statement_timeout': str(settings.DB_STATEMENT_TIMEOUT_MS)
+            }
+        }
+    return options
+
+
+@lru_cache(maxsize=None)
+def get_async_engine():
+    return create_async_engine(async_database_url(primary_url()), **async_engine_options())
+
+
+'''
+get_async_replica_engine()
+The engine of DATABASE_REPLICA_URL, or None without a replica.
+'''
+@lru_cache(maxsize=None)
+def get_async_replica_engine():
+    url = replica_url()
+    if not url:
+        return None
+    return create_async_engine(async_database_url(url), **async_engine_options())
+
+
+@lru_cache(maxsize=None)
+def get_async_session():
+    return sessionmaker(get_async_engine(), class_=AsyncSession, expire_on_commit=False)
+
+'''
+run_db(fn, *args)
+Calls fn(session, *args) in a fresh session and returns its result. The
+session is closed afterwards, rolling back anything fn did not commit.
+'''
+async def run_db(fn, *args):
+    async with get_async_session()() as session:
+        return await session.run_sync(fn, *args)
+
+
+'''
+run_read(fn, *args)
+run_db() for the read routes, on the replica when one is configured and
+reachable and on the primary otherwise. As with models.read_only, a
+replica that fails to hand out a connection is skipped for
+REPLICA_RETRY_INTERVAL seconds.
+'''
+replica_down_until = 0.0
+
+async def run_read(fn, *args):
+    global replica_down_until
+    engine = get_async_replica_engine()
+    if engine is not None and time.monotonic() >= replica_down_until:
+        try:
+            connection = await engine.connect()
+        except Exception:
+            replica_down_until = time.monotonic() + settings.REPLICA_RETRY_INTERVAL
+            print(sys.exc_info())
+        else:
+            try:
+                async with AsyncSession(bind=connection) as session:
+                    return await session.run_sync(fn, *args)
+            finally:
+                await connection.close()
+    return await run_db(fn, *args)
+
+
+@lru_cache(maxsize=None)
+def get_jwks_store():
+    return AsyncJWKSKeyStore(**jwks_options())
+
+'''
+verify_decode_jwt(token)
+auth.verify_decode_jwt() with the key lookup awaited. Shares the verified
+token cache with it.
+'''
+async def verify_decode_jwt(token):
+    start = time.perf_counter()
+    token_cache = get_token_cache()
+    payload = token_cache.get(token)
+    if payload is not None:
+        check_claims(payload)
+        JWT_VERIFY_SECONDS.labels('cache').observe(time.perf_counter() - start)
+        return payload
+
+    payload = decode_jwt(token, await get_jwks_store().get_key(unverified_kid(token)))
+    token_cache.put(token, payload)
+    JWT_VERIFY_SECONDS.labels('signature').observe(time.perf_counter() - start)
+    return payload
+
+'''
+requires_auth(permission)
+Same checks, rate limit and status codes as auth.requires_auth(). A shared
+rate limit store is called from a thread.
+'''
+def requires_auth(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            token = parse_auth_header(request.headers.get('Authorization', None))
+            try:
+                payload = await verify_decode_jwt(token)
+            except Exception:
+                abort(401)
+
+            check_permissions(permission, payload)
+
+            if rate_limiter.blocking:
+                retry_after = await asyncio.to_thread(rate_limiter.check, payload, permission)
+            else:
+                retry_after = rate_limiter.check(payload, permission)
+            if retry_after:
+                abort(429, retry_after=retry_after)
+
+            return await f(payload, *args, **kwargs)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+'''
+cache_call(method, *args)
+Calls a response_cache method, from a thread when its backend blocks.
+'''
+async def cache_call(method, *args):
+    if response_cache.blocking:
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+
+'''
+conditional(*tables)
+conditional.conditional() for Quart. The change versions are read with
+run_read() and left in `g.change_versions` for cached().
+'''
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            g.change_versions = await run_read(
+                lambda session: get_versions(*tables, session=session))
+            etag = make_etag(g.change_versions, request)
+            if request.if_none_match.contains(etag):
+                response = Response('', status=304)
+                response.set_etag(etag)
+                return response
+
+            response = await make_response(await f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+'''
+cached(*tags)
+ResponseCache.cached() for Quart, on the same backend, keys and tags.
+'''
+def cached(*tags):
+    def cached_decorator(f):
+        @wraps(f)
+        async def wrapper(payload, *args, **kwargs):
+            if response_cache.backend is None:
+                return await f(payload, *args, **kwargs)
+
+            key = response_cache.make_key(payload, request, g.change_versions)
+            body = await cache_call(response_cache.lookup, key)
+            if body is not None:
+                response_cache.hits += 1
+                return Response(body, status=200, mimetype='application/json')
+            response_cache.misses += 1
+
+            response = await make_response(await f(payload, *args, **kwargs))
+            if response.status_code == 200 and isinstance(response.response, DataBody):
+                await cache_call(response_cache.store, key, await response.get_data(),
+                                 [tag.format(**kwargs) for tag in tags])
+            return response
+
+        return wrapper
+    return cached_decorator
+
+
+async def invalidate(*tags):
+    await cache_call(response_cache.invalidate, *tags)
+
+
+class QuartJSONProvider(FastJSONMixin, DefaultJSONProvider):
+    pass
+
+
+'''
+warm_up()
+Opens a first pool connection to the primary and the replica and fetches
+the signing keys. Failures are logged and left to the first request to
+retry.
+'''
+async def warm_up():
+    jwks_store = get_jwks_store()
+    if jwks_store.url and not jwks_store.has_keys:
+        await jwks_store.refresh()
+    for engine in (get_async_engine(), get_async_replica_engine()):
+        if engine is None:
+            continue
+        try:
+            async with engine.connect():
+                pass
+        except Exception:
+            print(sys.exc_info())
+
+
+def create_app():
+    app = Quart(__name__)
+    app.json = QuartJSONProvider(app)
+    response_cache.init_app(app)
+    rate_limiter.init_app(app)
+
+    @app.before_serving
+    async def startup():
+        await warm_up()
+
+    @app.after_serving
+    async def shutdown():
+        await get_jwks_store().aclose()
+        for engine in (get_async_engine(), get_async_replica_engine()):
+            if engine is not None:
+                await engine.dispose()
+
+    @app.before_request
+    async def start_request_metrics():
+        start_request()
+
+    @app.after_request
+    async def record_request_metrics(response):
+        finish_request(request, response.status_code)
+        return response
+
+    @app.teardown_request
+    async def end_request_metrics(exception=None):
+        end_request()
+
+    @app.after_request
+    async def after_request(response):
+        response.headers.add("Access-Control-Allow-Origin", "*")
+        response.headers.add(
+            "Access-Control-Allow-Headers", "Content-Type,Authorization,If-None-Match,true"
+        )
+        response.headers.add(
+            "Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS,PATCH"
+        )
+        return response
+
+    '''
+    listing_response(listing, details_key, total_key)
+    The paginated or, with ?stream=true, streamed body of a collection route.
+    '''
+    async def listing_response(listing, details_key, total_key):
+        if request.args.get('stream') != 'true':
+            body, status_code = await run_read(
+                views.get_page, listing, request.args, details_key, total_key)
+            return jsonify(body), status_code
+
+        # Streamed in keyset pages of STREAM_CHUNK_SIZE, each page in its
+        # own short session, so no connection is held between chunks
+        rows, next_cursor, _ = await run_read(
+            views.load_page, listing, settings.STREAM_CHUNK_SIZE, None)
+        if not rows:
+            return jsonify(views.NOT_FOUND), 404
+        dumps = app.json.dumps
+
+        async def generate(rows, next_cursor):
+            total = len(rows)
+            yield '{"success": true, ' + dumps(details_key) + ': ['
+            yield ','.join(dumps(row) for row in rows)
+            while next_cursor:
+                rows, next_cursor, _ = await run_read(
+                    views.load_page, listing, settings.STREAM_CHUNK_SIZE,
+                    decode_cursor(next_cursor))
+                total += len(rows)
+                if rows:
+                    yield ',' + ','.join(dumps(row) for row in rows)
+            yield '], ' + dumps(total_key) + ': ' + str(total) + '}'
+
+        return Response(generate(rows, next_cursor), mimetype='application/json')
+
+
+# ----------------------------------------------------------------------------#
+# Controllers.
+# ----------------------------------------------------------------------------#
+
+
+    @app.route("/")
+    async def index():
+        return await render_template('index.html')
+
+
+    @app.route("/metrics")
+    async def get_metrics():
+        return Response(metrics_payload(), mimetype=CONTENT_TYPE_LATEST)
+
+
+#  Movies
+#  ----------------------------------------------------------------
+
+
+    @app.route("/movies")
+    @requires_auth('get:movies')
+    @conditional('movies', 'actors', 'performance')
+    @cached('movies', 'castings')
+    async def get_movies(payload):
+        return await listing_response(
+            views.movie_listing(request.args), 'movie_details', 'total actors')
+
+
+    @app.route("/movies/stats")
+    @requires_auth('get:movies')
+    @conditional('movies', 'performance')
+    @cached('movies', 'castings')
+    async def get_movie_stats(payload):
+        body, status_code = await run_read(views.get_movie_stats, request.args)
+        return jsonify(body), status_code
+
+
+    @app.route("/movies/<movie_id>")
+    @requires_auth('get:movies')
+    @conditional('movies', 'actors', 'performance')
+    @cached('movie:{movie_id}', 'castings')
+    async def get_movie(payload, movie_id):
+        body, status_code = await run_read(views.get_movie, movie_id, request.args)
+        return jsonify(body), status_code
+
+
+    @app.route("/movies", methods=['POST'])
+    @requires_auth('post:movies')
+    async def create_movies(payload):
+        body, status_code = await run_db(
+            views.create_movie, await request.get_json(silent=True))
+        await invalidate('movies')
+        return jsonify(body), status_code
+
+
+    @app.route("/movies/bulk", methods=['POST'])
+    @requires_auth('post:movies')
+    async def create_movies_bulk(payload):
+        body, status_code = await run_db(
+            views.create_movies_bulk, await request.get_json(silent=True))
+        if status_code == 200:
+            await invalidate('movies')
+        return jsonify(body), status_code
+
+
+    @app.route("/movies/<movie_id>", methods=['DELETE'])
+    @requires_auth('delete:movies')
+    async def delete_movie(payload, movie_id):
+        body, status_code = await run_db(views.delete_movie, movie_id)
+        await invalidate('movies', 'castings', 'movie:%s' % movie_id)
+        return jsonify(body), status_code
+
+
+    @app.route("/movies/<movie_id>", methods=['PATCH'])
+    @requires_auth('post:movies')
+    async def patch_movie(payload, movie_id):
+        body, status_code = await run_db(
+            views.patch_movie, movie_id, await request.get_json(silent=True))
+        await invalidate('movies', 'castings', 'movie:%s' % movie_id)
+        return jsonify(body), status_code
+
+
+#  Actors
+#  ----------------------------------------------------------------
+
+
+    @app.route("/actors")
+    @requires_auth('get:actors')
+    @conditional('movies', 'actors', 'performance')
+    @cached('actors', 'castings')
+    async def get_actors(payload):
+        return await listing_response(
+            views.actor_listing(request.args), 'actor_details', 'total_actors')
+
+
+    @app.route("/actors/stats")
+    @requires_auth('get:actors')
+    @conditional('movies', 'actors', 'performance')
+    @cached('actors', 'castings')
+    async def get_actor_stats(payload):
+        body, status_code = await run_read(views.get_actor_stats, request.args)
+        return jsonify(body), status_code
+
+
+    @app.route("/actors/<actor_id>")
+    @requires_auth('get:actors')
+    @conditional('movies', 'actors', 'performance')
+    @cached('actor:{actor_id}', 'castings')
+    async def get_actor(payload, actor_id):
+        body, status_code = await run_read(views.get_actor, actor_id, request.args)
+        return jsonify(body), status_code
+
+
+    @app.route("/actors", methods=['POST'])
+    @requires_auth('post:actors')
+    async def create_actor(payload):
+        body, status_code = await run_db(
+            views.create_actor, await request.get_json(silent=True))
+        await invalidate('actors')
+        return jsonify(body), status_code
+
+
+    @app.route("/actors/bulk", methods=['POST'])
+    @requires_auth('post:actors')
+    async def create_actors_bulk(payload):
+        body, status_code = await run_db(
+            views.create_actors_bulk, await request.get_json(silent=True))
+        if status_code == 200:
+            await invalidate('actors')
+        return jsonify(body), status_code
+
+
+    @app.route("/actors/<actor_id>", methods=['DELETE'])
+    @requires_auth('delete:actors')
+    async def delete_actor(payload, actor_id):
+        body, status_code = await run_db(views.delete_actor, actor_id)
+        await invalidate('actors', 'castings', 'actor:%s' % actor_id)
+        return jsonify(body), status_code
+
+
+    @app.route("/actors/<actor_id>", methods=['PATCH'])
+    @requires_auth('post:actors')
+    async def patch_actor(payload, actor_id):
+        body, status_code = await run_db(
+            views.patch_actor, actor_id, await request.get_json(silent=True))
+        await invalidate('actors', 'castings', 'actor:%s' % actor_id)
+        return jsonify(body), status_code
+
+
+#  Perfermance
+#  ----------------------------------------------------------------
+
+    @app.route("/performances")
+    @requires_auth('get:performance')
+    @conditional('movies', 'actors', 'performance')
+    @cached('castings')
+    async def get_perfermance(payload):
+        return await listing_response(
+            views.performance_listing(), 'performance_details', 'total_performances')
+
+
+    @app.route("/performance", methods=['POST'])
+    @requires_auth('post:performance')
+    async def create_performance(payload):
+        body, status_code = await run_db(
+            views.create_performance, await request.get_json(silent=True))
+        if status_code == 200:
+            await invalidate('castings')
+        return jsonify(body), status_code
+
+
+    @app.route("/performance/bulk", methods=['POST'])
+    @requires_auth('post:performance')
+    async def create_performances_bulk(payload):
+        body, status_code = await run_db(
+            views.create_performances_bulk, await request.get_json(silent=True))
+        if status_code == 200 and body["total_created"]:
+            await invalidate('castings')
+        return jsonify(body), status_code
+
+
+#  Error Handling
+#  ----------------------------------------------------------------
+
+    def error_response(status_code, message):
+        return jsonify({
+            "success": False,
+            "error": status_code,
+            "message": message
+        }), status_code
+
+    for status_code, message in ((400, "Bad Request"), (401, "Unauthorized"),
+                                 (403, "Forbidden"), (422, "Unprocessable"),
+                                 (404, "Resource Not Found"), (405, "Method Not Allowed"),
+                                 (500, "Internal Server Error")):
+        app.register_error_handler(
+            status_code,
+            lambda error, status_code=status_code, message=message:
+                error_response(status_code, message))
+
+    @app.errorhandler(429)
+    async def toomanyrequests(error):
+        response, status_code = error_response(429, "Too Many Requests")
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, status_code
+
+    @app.errorhandler(AuthError)
+    async def autherror(error):
+        return jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": error.error
+        }), error.status_code
+
+
+    return app
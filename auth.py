@@ -1,14 +1,56 @@
-import json
 from flask import request, abort
-from functools import wraps
+import time
+from functools import lru_cache, wraps
 from jose import jwt
-from urllib.request import urlopen
 from config import settings
+from jwks import JWKSKeyStore
+from token_cache import VerifiedTokenCache
+from metrics import JWT_VERIFY_SECONDS
+from rate_limit import rate_limiter
 
 
-AUTH0_DOMAIN = settings.AUTH0_DOMAIN
-ALGORITHMS = settings.ALGORITHMS
-API_AUDIENCE = settings.API_AUDIENCE
+'''
+Auth settings, the key store and the token cache are resolved on first use,
+so importing this module reads no configuration and opens no connections.
+'''
+def issuer():
+    return 'https://' + settings.AUTH0_DOMAIN + '/'
+
+'''
+jwks_url()
+Where signing keys are fetched from. With only JWKS_FILE set the store runs
+offline from that file and this is None.
+'''
+def jwks_url():
+    if settings.JWKS_URL or not settings.JWKS_FILE:
+        return settings.JWKS_URL or f"https://{settings.AUTH0_DOMAIN}/.well-known/jwks.json"
+    return None
+
+def jwks_options():
+    return {
+        'url': jwks_url(),
+        'jwks_file': settings.JWKS_FILE,
+        'ttl': settings.JWKS_CACHE_TTL,
+        'refresh_margin': settings.JWKS_REFRESH_MARGIN,
+        'min_refetch_interval': settings.JWKS_MIN_REFETCH_INTERVAL
+    }
+
+'''
+get_jwks_store()
+The process wide signing key cache.
+'''
+@lru_cache(maxsize=None)
+def get_jwks_store():
+    return JWKSKeyStore(**jwks_options())
+
+'''
+get_token_cache()
+Payloads of tokens that already passed signature verification, so repeat
+bearers skip the RSA check until their token expires.
+'''
+@lru_cache(maxsize=None)
+def get_token_cache():
+    return VerifiedTokenCache(maxsize=settings.TOKEN_CACHE_SIZE)
 
 ## AuthError Exception
 '''
@@ -30,7 +72,13 @@ This method gets the header from a request and performs multiple checks on the
 '''
 
 def get_token_auth_header():
-    auth_header = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+'''
+parse_auth_header(auth_header)
+The checks behind get_token_auth_header(), on the raw header value.
+'''
+def parse_auth_header(auth_header):
     if not auth_header:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -76,41 +124,68 @@ def check_permissions(permission, payload):
     return True
 
 '''
-Verify keys ,decode jwt token and return payload.
+This method checks audience and issuer of an already verified payload.
+'''
+def check_claims(payload):
+    audience = payload.get('aud')
+    if isinstance(audience, str):
+        audience = [audience]
+    if (settings.API_AUDIENCE not in (audience or []) or
+            payload.get('iss') != issuer()):
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Please, check the audience and issuer.'
+        }, 401)
+    return True
 
+'''
+Verify keys ,decode jwt token and return payload.
+Tokens seen before are served from the token cache, their claims are still
+checked on every call.
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    start = time.perf_counter()
+    token_cache = get_token_cache()
+    payload = token_cache.get(token)
+    if payload is not None:
+        check_claims(payload)
+        JWT_VERIFY_SECONDS.labels('cache').observe(time.perf_counter() - start)
+        return payload
+
+    payload = decode_jwt(token, get_jwks_store().get_key(unverified_kid(token)))
+    token_cache.put(token, payload)
+    JWT_VERIFY_SECONDS.labels('signature').observe(time.perf_counter() - start)
+    return payload
+
+'''
+unverified_kid(token)
+Returns the `kid` from the token header, used to pick the signing key.
+'''
+def unverified_kid(token):
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+'''
+decode_jwt(token, rsa_key)
+Verifies the signature and claims of `token` against `rsa_key` and returns
+the payload.
+'''
+def decode_jwt(token, rsa_key):
     if rsa_key:
         try:
-            payload = jwt.decode(
+            return jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=settings.ALGORITHMS,
+                audience=settings.API_AUDIENCE,
+                issuer=issuer()
             )
 
-            return payload
-
         except jwt.ExpiredSignatureError:
             raise AuthError({
                 'code': 'token_expired',
@@ -137,6 +212,7 @@ def verify_decode_jwt(token):
 '''
 This decorator method gets the token, verifies and decodes the jwt and 
 check the requested permissions. Returns the payload from jwt.
+Callers over their rate limit get 429 before the view runs.
 '''
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
@@ -150,6 +226,10 @@ def requires_auth(permission=''):
 
             check_permissions(permission, payload)
 
+            retry_after = rate_limiter.check(payload, permission)
+            if retry_after:
+                abort(429, retry_after=retry_after)
+
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,154 @@
+'''
+Query plans for the castings join and cascade deletes, without and with the
+indexes added in migration 0c36fe64684c.
+
+Everything runs inside one transaction that is rolled back at the end: the
+script seeds synthetic rows with generate_series, drops the indexes, runs
+EXPLAIN ANALYZE, recreates the indexes and runs it again. The database it
+points at is left exactly as it was, but the tables stay locked until the
+rollback, so point it at a development or staging database.
+
+    python benchmarks/index_plans.py --database-url postgresql://... \
+        --movies 100000 --actors 100000 --castings 1000000
+'''
+import argparse
+import json
+import os
+import re
+
+from sqlalchemy import create_engine, text
+
+
+INDEXES = {
+    'ix_performance_actor_id': 'CREATE INDEX ix_performance_actor_id ON performance (actor_id)',
+    'ix_performance_movie_id': 'CREATE INDEX ix_performance_movie_id ON performance (movie_id)',
+    'ix_movies_release_date': 'CREATE INDEX ix_movies_release_date ON movies (release_date)',
+    'ix_movies_title': 'CREATE INDEX ix_movies_title ON movies (title)',
+    'ix_actors_name': 'CREATE INDEX ix_actors_name ON actors (name)',
+}
+
+QUERIES = {
+    'movie_cast_join': (
+        'SELECT actors.id, actors.name, actors.age, actors.gender '
+        'FROM actors JOIN performance ON actors.id = performance.actor_id '
+        'WHERE performance.movie_id = :movie_id'
+    ),
+    'actor_castings_join': (
+        'SELECT movies.id, movies.title, movies.release_date '
+        'FROM movies JOIN performance ON movies.id = performance.movie_id '
+        'WHERE performance.actor_id = :actor_id'
+    ),
+    'movie_cascade_delete': 'DELETE FROM movies WHERE id = :movie_id',
+    'actor_cascade_delete': 'DELETE FROM actors WHERE id = :actor_id',
+    'movies_by_release_date': (
+        'SELECT id, title FROM movies '
+        "WHERE release_date >= :since ORDER BY release_date LIMIT 100"
+    ),
+}
+
+
+def seed(conn, movies, actors, castings):
+    conn.execute(text(
+        "INSERT INTO movies (title, release_date) "
+        "SELECT 'Movie ' || n, timestamp '1950-01-01' + n * interval '1 hour' "
+        "FROM generate_series(1, :n) AS n"), {'n': movies})
+    conn.execute(text(
+        "INSERT INTO actors (name, age, gender) "
+        "SELECT 'Actor ' || n, 18 + n % 60, CASE WHEN n % 2 = 0 THEN 'Female' ELSE 'Male' END "
+        "FROM generate_series(1, :n) AS n"), {'n': actors})
+    conn.execute(text('SELECT setseed(0.42)'))
+    conn.execute(text(
+        "INSERT INTO performance (actor_id, movie_id) "
+        "SELECT a.min + floor(random() * (a.max - a.min + 1))::int, "
+        "       m.min + floor(random() * (m.max - m.min + 1))::int "
+        "FROM generate_series(1, :n) AS n, "
+        "     (SELECT min(id), max(id) FROM actors) AS a, "
+        "     (SELECT min(id), max(id) FROM movies) AS m "
+        "ON CONFLICT DO NOTHING"), {'n': castings})
+    conn.execute(text('ANALYZE movies'))
+    conn.execute(text('ANALYZE actors'))
+    conn.execute(text('ANALYZE performance'))
+
+
+def explain_all(conn, params):
+    results = {}
+    for name, query in QUERIES.items():
+        # Each statement runs in a savepoint so the deletes do not change
+        # what the next statement sees
+        savepoint = conn.begin_nested()
+        plan = [row[0] for row in conn.execute(
+            text('EXPLAIN (ANALYZE, BUFFERS) ' + query), params)]
+        savepoint.rollback()
+        results[name] = {
+            'execution_ms': execution_ms(plan),
+            'plan': plan
+        }
+    return results
+
+
+# Execution Time includes the FK triggers that perform cascades
+def execution_ms(plan):
+    for line in plan:
+        match = re.match(r'Execution Time: ([\d.]+) ms', line)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    default_url = os.getenv('DATABASE_URL')
+    parser.add_argument('--database-url', default=default_url, required=default_url is None,
+                        help='defaults to DATABASE_URL')
+    parser.add_argument('--movies', type=int, default=100000)
+    parser.add_argument('--actors', type=int, default=100000)
+    parser.add_argument('--castings', type=int, default=1000000)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    database_url = args.database_url.replace('postgres://', 'postgresql://', 1)
+    engine = create_engine(database_url)
+
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            seed(conn, args.movies, args.actors, args.castings)
+            params = {
+                'movie_id': conn.execute(text('SELECT max(id) FROM movies')).scalar(),
+                'actor_id': conn.execute(text('SELECT max(id) FROM actors')).scalar(),
+                'since': '1990-01-01'
+            }
+
+            for name in INDEXES:
+                conn.execute(text('DROP INDEX IF EXISTS ' + name))
+            before = explain_all(conn, params)
+
+            for statement in INDEXES.values():
+                conn.execute(text(statement))
+            conn.execute(text('ANALYZE'))
+            after = explain_all(conn, params)
+        finally:
+            transaction.rollback()
+
+    report = {
+        'rows': {'movies': args.movies, 'actors': args.actors, 'castings': args.castings},
+        'before': before,
+        'after': after
+    }
+
+    for name in QUERIES:
+        print('== %s: %.3f ms -> %.3f ms' % (
+            name, before[name]['execution_ms'], after[name]['execution_ms']))
+        print('-- without indexes')
+        print('\n'.join(before[name]['plan']))
+        print('-- with indexes')
+        print('\n'.join(after[name]['plan']))
+        print()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+'''
+Serialization cost of a /movies and an /actors listing page: the previous
+path (strftime per row, Flask's default JSON provider) against
+json_provider.FastJSONProvider with the standard library and with orjson.
+
+Rows are built in memory, so no database is needed.
+
+    python benchmarks/json_serialization.py --rows 1000 --cast 10
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from models import Movie, Actor
+import json_provider
+from json_provider import FastJSONProvider
+
+
+def make_rows(rows, cast):
+    actors = []
+    for n in range(rows):
+        actor = Actor(name='Actor %d' % n, age=18 + n % 60,
+                      gender='Female' if n % 2 else 'Male')
+        actor.id = n + 1
+        actors.append(actor)
+
+    movies = []
+    for n in range(rows):
+        movie = Movie(title='Movie %d' % n,
+                      release_date=datetime(2000, 1, 1) + timedelta(days=n % 365))
+        movie.id = n + 1
+        movie.actor = [actors[(n + k) % rows] for k in range(cast)]
+        movies.append(movie)
+    return movies, actors
+
+
+# The listing shapes as they were built before json_provider
+def strftime_movie(movie):
+    return {
+        'actors:': [
+            {
+                "actor_id": x.id,
+                "actor_name": x.name,
+                "actor_age": x.age,
+                "actor_gender": x.gender
+            }
+            for x in movie.actor
+        ],
+        'movie_id': movie.id,
+        'movie_title': movie.title,
+        'movie_release_date': movie.release_date.strftime("%B %d %Y %H:%M:%S")
+    }
+
+
+def strftime_actor(actor):
+    return {
+        'casting:': [
+            {
+                "movie_id": x.id,
+                "movie_title": x.title,
+                "movie_release_date": x.release_date.strftime("%B %d %Y %H:%M:%S")
+            }
+            for x in actor.movies
+        ],
+        'actor_id': actor.id,
+        'actor_name': actor.name,
+        'actor_age': actor.age,
+        'actor_gender': actor.gender
+    }
+
+
+def provider(app, cls, use_orjson=None):
+    instance = cls(app)
+    if use_orjson is not None:
+        instance.use_orjson = use_orjson
+    return instance
+
+
+def measure(app, dumps, rows, format_row, number):
+    def run():
+        with app.app_context():
+            dumps({'success': True, 'details': [format_row(row) for row in rows]})
+    # Dates are cached across runs, as they are across requests
+    json_provider.format_datetime.cache_clear()
+    return min(timeit.repeat(run, number=number, repeat=5)) / number * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--cast', type=int, default=10)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    movies, actors = make_rows(args.rows, args.cast)
+
+    variants = {
+        'previous': (provider(app, DefaultJSONProvider), strftime_movie, strftime_actor),
+        'fast_json': (provider(app, FastJSONProvider, False),
+                      Movie.format_listing, Actor.format_listing),
+    }
+    if json_provider.orjson is not None:
+        variants['fast_orjson'] = (provider(app, FastJSONProvider, True),
+                                   Movie.format_listing, Actor.format_listing)
+
+    report = {'rows': args.rows, 'cast': args.cast, 'ms_per_page': {}}
+    for name, (instance, format_movie, format_actor) in variants.items():
+        result = {
+            'movies': measure(app, instance.dumps, movies, format_movie, args.number),
+            'actors': measure(app, instance.dumps, actors, format_actor, args.number)
+        }
+        report['ms_per_page'][name] = result
+        print('%-12s %s' % (name, '  '.join(
+            '%s %.2f ms' % item for item in result.items())))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+'''
+Load test for every route of the API, against a local database and without
+Auth0.
+
+The script
+  - seeds the database with seed.seed_database (--reset recreates the
+    tables first),
+  - generates an RSA key, serves its JWKS from a stub HTTP server and signs
+    tokens carrying every permission with it,
+  - starts the API under gunicorn (or uvicorn with --server asgi),
+  - drives each route with --concurrency clients for --requests requests,
+  - and reports throughput, p50/p95/p99 latency, status codes and SQL
+    statements per request, the latter read from the server's /metrics.
+
+The JSON report carries the commit it ran against, so runs can be compared
+across commits:
+
+    python benchmarks/load_test.py --database-url postgresql://... --reset \
+        --movies 10000 --actors 10000 --castings 100000 --output before.json
+
+The tables of the target database are dropped with --reset and written to
+in any case; point it at a throwaway database.
+'''
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+from prometheus_client.parser import text_string_to_metric_families
+from sqlalchemy import create_engine, text
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from models import db
+from seed import seed_database
+
+DOMAIN = 'load-test.local'
+AUDIENCE = 'castagenAPI'
+KID = 'load-test'
+PERMISSIONS = [
+    'get:movies', 'post:movies', 'delete:movies',
+    'get:actors', 'post:actors', 'delete:actors',
+    'get:performance', 'post:performance'
+]
+BULK_SIZE = 100
+
+
+'''
+Auth
+'''
+def b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def make_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    numbers = key.public_key().public_numbers()
+    jwks = {'keys': [{
+        'kty': 'RSA', 'kid': KID, 'use': 'sig', 'alg': 'RS256',
+        'n': b64(numbers.n), 'e': b64(numbers.e)
+    }]}
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    return pem, jwks
+
+
+def make_token(pem):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': 'https://%s/' % DOMAIN,
+        'sub': 'load-test',
+        'aud': AUDIENCE,
+        'iat': now,
+        'exp': now + 24 * 3600,
+        'permissions': PERMISSIONS
+    }, pem, algorithm='RS256', headers={'kid': KID})
+
+
+def serve_jwks(jwks):
+    body = json.dumps(jwks).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/.well-known/jwks.json' % server.server_port
+
+
+'''
+Database
+'''
+def reset_schema(database_url):
+    engine = create_engine(database_url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+
+def seed(database_url, movies, actors, castings, seed_value):
+    engine = create_engine(database_url)
+    seed_database(engine, movies, actors, castings, seed=seed_value)
+    with engine.connect() as conn:
+        ids = {
+            'movies': [row[0] for row in conn.execute(text('SELECT id FROM movies'))],
+            'actors': [row[0] for row in conn.execute(text('SELECT id FROM actors'))]
+        }
+    engine.dispose()
+    return ids
+
+
+'''
+Server
+'''
+def start_server(kind, port, workers, env):
+    if kind == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:create_app', '--factory',
+                   '--port', str(port), '--workers', str(workers),
+                   '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', 'app:create_app()',
+                   '--bind', '127.0.0.1:%d' % port, '--workers', str(workers),
+                   '--log-level', 'warning']
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+
+    base_url = 'http://127.0.0.1:%d' % port
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('The server exited with code %d' % process.returncode)
+        try:
+            requests.get(base_url + '/', timeout=5)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('The server did not start within 60 seconds')
+
+
+def statement_counts(base_url):
+    counts = {}
+    body = requests.get(base_url + '/metrics', timeout=30).text
+    for family in text_string_to_metric_families(body):
+        if family.name != 'db_statements_per_request':
+            continue
+        for sample in family.samples:
+            route = sample.labels.get('route')
+            if sample.name.endswith('_sum'):
+                counts.setdefault(route, [0.0, 0.0])[0] += sample.value
+            elif sample.name.endswith('_count'):
+                counts.setdefault(route, [0.0, 0.0])[1] += sample.value
+    return counts
+
+
+'''
+Scenarios
+
+One per route and shape of request: (name, method, route rule, build)
+where build(i) returns the path and JSON body of the i-th request. Writes
+that need existing rows use the ids seeded or created by earlier scenarios.
+'''
+def scenarios(ids, rng):
+    created = {'movies': [], 'actors': []}
+
+    def pick(table):
+        return rng.choice(ids[table])
+
+    def take(table):
+        return created[table].pop() if created[table] else pick(table)
+
+    def movie(i):
+        return {'title': 'Load movie %d' % i, 'release_date': '2020-01-01T00:00:00'}
+
+    def actor(i):
+        return {'name': 'Load actor %d' % i, 'age': 20 + i % 50, 'gender': 'Female'}
+
+    def pairs():
+        return [{'actor_id': pick('actors'), 'movie_id': pick('movies')}
+                for _ in range(BULK_SIZE)]
+
+    return created, [
+        ('index', 'GET', '/', lambda i: ('/', None)),
+        ('metrics', 'GET', '/metrics', lambda i: ('/metrics', None)),
+        ('movies_list', 'GET', '/movies', lambda i: ('/movies?limit=100', None)),
+        ('movies_list_sparse', 'GET', '/movies',
+            lambda i: ('/movies?limit=100&fields=title', None)),
+        ('movies_search', 'GET', '/movies',
+            lambda i: ('/movies?limit=100&title=movie 1%d' % (i % 10), None)),
+        ('movies_stats', 'GET', '/movies/stats',
+            lambda i: ('/movies/stats?released_after=%d-01-01' % (1920 + i % 100), None)),
+        ('movie_get', 'GET', '/movies/<movie_id>',
+            lambda i: ('/movies/%d?include=actors' % pick('movies'), None)),
+        ('actors_list', 'GET', '/actors', lambda i: ('/actors?limit=100', None)),
+        ('actors_search', 'GET', '/actors',
+            lambda i: ('/actors?limit=100&gender=Female&age_min=30&age_max=40', None)),
+        ('actors_stats', 'GET', '/actors/stats',
+            lambda i: ('/actors/stats?released_after=%d-01-01' % (1920 + i % 100), None)),
+        ('actor_get', 'GET', '/actors/<actor_id>',
+            lambda i: ('/actors/%d?include=movies' % pick('actors'), None)),
+        ('performances_list', 'GET', '/performances',
+            lambda i: ('/performances?limit=100', None)),
+        ('movies_create', 'POST', '/movies', lambda i: ('/movies', movie(i))),
+        ('movies_bulk', 'POST', '/movies/bulk',
+            lambda i: ('/movies/bulk', [movie(i * BULK_SIZE + k) for k in range(BULK_SIZE)])),
+        ('movie_patch', 'PATCH', '/movies/<movie_id>',
+            lambda i: ('/movies/%d' % pick('movies'), {'title': 'Patched %d' % i})),
+        ('actors_create', 'POST', '/actors', lambda i: ('/actors', actor(i))),
+        ('actors_bulk', 'POST', '/actors/bulk',
+            lambda i: ('/actors/bulk', [actor(i * BULK_SIZE + k) for k in range(BULK_SIZE)])),
+        ('actor_patch', 'PATCH', '/actors/<actor_id>',
+            lambda i: ('/actors/%d' % pick('actors'), {'age': 20 + i % 50})),
+        ('performance_create', 'POST', '/performance',
+            lambda i: ('/performance', pairs()[0])),
+        ('performance_bulk', 'POST', '/performance/bulk',
+            lambda i: ('/performance/bulk', pairs())),
+        ('movie_delete', 'DELETE', '/movies/<movie_id>',
+            lambda i: ('/movies/%d' % take('movies'), None)),
+        ('actor_delete', 'DELETE', '/actors/<actor_id>',
+            lambda i: ('/actors/%d' % take('actors'), None)),
+    ]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def run_scenario(base_url, token, method, build, total, concurrency, created):
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    errors = 0
+
+    # Built up front so that picking ids is not part of the latency
+    plan = [build(i) for i in range(total)]
+
+    def send(request):
+        nonlocal errors
+        path, body = request
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            local.session.headers['Authorization'] = 'Bearer ' + token
+        start = time.perf_counter()
+        try:
+            response = local.session.request(method, base_url + path, json=body, timeout=60)
+            elapsed = time.perf_counter() - start
+            status = response.status_code
+            if method == 'POST' and status == 200:
+                data = response.json()
+                table = 'movies' if path.startswith('/movies') else 'actors'
+                if path.startswith(('/movies', '/actors')):
+                    new_ids = data.get('ids') or [data.get('id')]
+                    with lock:
+                        created[table].extend(new_ids)
+        except requests.RequestException:
+            elapsed = time.perf_counter() - start
+            status = 'error'
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 'error' or (isinstance(status, int) and status >= 500):
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, plan))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': total,
+        'errors': errors,
+        'statuses': {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        'seconds': elapsed,
+        'throughput_rps': total / elapsed,
+        'p50_ms': percentile(latencies, .50) * 1000,
+        'p95_ms': percentile(latencies, .95) * 1000,
+        'p99_ms': percentile(latencies, .99) * 1000
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True,
+            stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and recreate the tables before seeding')
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--castings', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--only', help='comma-separated scenario names to run')
+    parser.add_argument('--no-response-cache', action='store_true',
+                        help='measure the read routes without the response cache')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    if not args.database_url:
+        raise SystemExit('Set --database-url or DATABASE_URL')
+    database_url = args.database_url.replace('postgres://', 'postgresql://', 1)
+
+    if args.reset:
+        reset_schema(database_url)
+    print('Seeding %d movies, %d actors, %d castings' % (
+        args.movies, args.actors, args.castings))
+    ids = seed(database_url, args.movies, args.actors, args.castings, args.seed)
+
+    pem, jwks = make_key()
+    jwks_server, jwks_url = serve_jwks(jwks)
+    token = make_token(pem)
+
+    metrics_dir = tempfile.mkdtemp(prefix='load-test-metrics-')
+    env = dict(os.environ,
+               DATABASE_URL=database_url,
+               AUTH0_DOMAIN=DOMAIN,
+               API_AUDIENCE=AUDIENCE,
+               ALGORITHMS='RS256',
+               JWKS_URL=jwks_url,
+               PROMETHEUS_MULTIPROC_DIR=metrics_dir)
+    env.pop('JWKS_FILE', None)
+    if args.no_response_cache:
+        env['RESPONSE_CACHE_BACKEND'] = 'none'
+
+    process, base_url = start_server(args.server, args.port, args.workers, env)
+    rng = random.Random(args.seed)
+    created, plans = scenarios(ids, rng)
+    only = set(args.only.split(',')) if args.only else None
+
+    report = {
+        'commit': git_commit(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {
+            'server': args.server,
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'movies': args.movies,
+            'actors': args.actors,
+            'castings': args.castings,
+            'response_cache': not args.no_response_cache
+        },
+        'scenarios': {}
+    }
+    try:
+        for name, method, rule, build in plans:
+            if only is not None and name not in only:
+                continue
+            before = statement_counts(base_url)
+            result = run_scenario(base_url, token, method, build,
+                                  args.requests, args.concurrency, created)
+            after = statement_counts(base_url)
+
+            statements, count = [
+                after.get(rule, [0, 0])[k] - before.get(rule, [0, 0])[k] for k in (0, 1)]
+            result['queries_per_request'] = statements / count if count else None
+            report['scenarios'][name] = result
+            print('%-20s %8.1f req/s  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  '
+                  '%s queries/req  %s' % (
+                      name, result['throughput_rps'], result['p50_ms'],
+                      result['p95_ms'], result['p99_ms'],
+                      '%.2f' % result['queries_per_request']
+                      if result['queries_per_request'] is not None else '-',
+                      result['statuses']))
+    finally:
+        process.terminate()
+        process.wait()
+        jwks_server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
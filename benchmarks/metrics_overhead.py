@@ -0,0 +1,102 @@
+'''
+Cost of the request metrics: the per-request hooks from metrics.py, the
+engine listeners per SQL statement, and a trivial Flask route served with
+and without track_requests().
+
+Runs on an in-memory SQLite database, no other service is needed. Set
+PROMETHEUS_MULTIPROC_DIR to an empty directory to measure the multiprocess
+mode used under gunicorn.
+
+    python benchmarks/metrics_overhead.py --requests 20000
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+
+import metrics
+
+
+def per_call_us(run, number):
+    return min(timeit.repeat(run, number=number, repeat=5)) / number * 1e6
+
+
+def hooks_us(number):
+    app = Flask(__name__)
+    app.add_url_rule('/movies/<movie_id>', 'movie', lambda movie_id: '')
+
+    with app.test_request_context('/movies/1'):
+        from flask import request
+
+        def run():
+            metrics.start_request()
+            metrics.finish_request(request, 200)
+            metrics.end_request()
+
+        return per_call_us(run, number)
+
+
+def statement_us(number):
+    engine = create_engine('sqlite://')
+    with engine.connect() as conn:
+        statement = text('SELECT 1')
+
+        def run():
+            conn.execute(statement)
+
+        metrics._request_stats.set([0.0, 0, 0.0, 0.0])
+        with_listeners = per_call_us(run, number)
+        metrics._request_stats.set(None)
+
+        event.remove(Engine, 'before_cursor_execute', metrics._before_cursor_execute)
+        event.remove(Engine, 'after_cursor_execute', metrics._after_cursor_execute)
+        try:
+            without_listeners = per_call_us(run, number)
+        finally:
+            event.listen(Engine, 'before_cursor_execute', metrics._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', metrics._after_cursor_execute)
+    return with_listeners - without_listeners
+
+
+def route_us(number, tracked):
+    app = Flask(__name__)
+    app.add_url_rule('/ping', 'ping', lambda: 'ok')
+    if tracked:
+        metrics.track_requests(app)
+    client = app.test_client()
+    return per_call_us(lambda: client.get('/ping'), number)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    plain = route_us(args.requests // 4, False)
+    tracked = route_us(args.requests // 4, True)
+    report = {
+        'multiprocess': 'PROMETHEUS_MULTIPROC_DIR' in os.environ,
+        'hooks_us_per_request': hooks_us(args.requests),
+        'listeners_us_per_statement': statement_us(args.requests),
+        'route_us_untracked': plain,
+        'route_us_tracked': tracked,
+        'route_us_overhead': tracked - plain
+    }
+    for name, value in report.items():
+        print('%-28s %s' % (name, '%.2f' % value if isinstance(value, float) else value))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+'''
+Startup cost of the API: how long `import app` takes in a fresh
+interpreter, how long create_app() and warm_up() take, and how long the
+first and second authenticated requests take after that, with and without
+the warm-up. Then the same for a gunicorn worker: time until it answers,
+and the first authenticated request.
+
+Every in-process run uses a new interpreter, so imports, engines, pools and
+keys all start cold. Signing keys come from a stub JWKS endpoint, as in
+load_test.py. Only GET /movies?limit=1 is requested, so any database at
+migration head will do:
+
+    python benchmarks/startup.py --database-url postgresql://... --output startup.json
+
+The JSON report carries the commit it ran against, to track startup time
+across commits.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+from load_test import (ROOT, DOMAIN, AUDIENCE, make_key, make_token, serve_jwks,
+                       start_server, git_commit)
+
+
+CHILD = '''
+import json, os, sys, time
+start = time.perf_counter()
+import app as module
+timings = {'import': time.perf_counter() - start}
+
+start = time.perf_counter()
+application = module.create_app()
+timings['create_app'] = time.perf_counter() - start
+
+if sys.argv[1] == 'warm':
+    start = time.perf_counter()
+    module.warm_up(application)
+    timings['warm_up'] = time.perf_counter() - start
+
+client = application.test_client()
+headers = {'Authorization': 'Bearer ' + os.environ['STARTUP_TOKEN']}
+for name in ('first_request', 'second_request'):
+    start = time.perf_counter()
+    response = client.get('/movies?limit=1', headers=headers)
+    timings[name] = time.perf_counter() - start
+    assert response.status_code == 200, response.status_code
+print(json.dumps(timings))
+'''
+
+
+def run_child(env, mode):
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, mode], cwd=ROOT, env=env, check=True,
+        stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def interpreter_seconds():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - start
+
+
+'''
+import_profile(env)
+The modules with the highest cumulative import time, from -X importtime.
+'''
+def import_profile(env, top):
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, env=env,
+        check=True, stderr=subprocess.PIPE).stderr.decode('utf-8')
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), name.strip()))
+    modules.sort(reverse=True)
+    return [{'module': name, 'cumulative_ms': us / 1000} for us, name in modules[:top]]
+
+
+def server_startup(env, port, token):
+    start = time.perf_counter()
+    process, base_url = start_server('wsgi', port, 1, env)
+    ready = time.perf_counter() - start
+    try:
+        start = time.perf_counter()
+        response = requests.get(base_url + '/movies?limit=1', timeout=30,
+                                headers={'Authorization': 'Bearer ' + token})
+        first = time.perf_counter() - start
+        response.raise_for_status()
+    finally:
+        process.terminate()
+        process.wait()
+    return {'ready': ready, 'first_request': first}
+
+
+def medians(runs):
+    return {name: round(statistics.median(run[name] for run in runs) * 1000, 2)
+            for name in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold starts per measurement, medians are reported')
+    parser.add_argument('--port', type=int, default=8098)
+    parser.add_argument('--top', type=int, default=15,
+                        help='slowest imports to list')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    if not args.database_url:
+        raise SystemExit('Set --database-url or DATABASE_URL')
+
+    pem, jwks = make_key()
+    jwks_server, jwks_url = serve_jwks(jwks)
+    token = make_token(pem)
+    env = dict(os.environ,
+               DATABASE_URL=args.database_url,
+               AUTH0_DOMAIN=DOMAIN,
+               API_AUDIENCE=AUDIENCE,
+               ALGORITHMS='RS256',
+               JWKS_URL=jwks_url,
+               STARTUP_TOKEN=token,
+               RESPONSE_CACHE_BACKEND='none')
+    env.pop('JWKS_FILE', None)
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+
+    try:
+        report = {
+            'commit': git_commit(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'runs': args.runs,
+            'interpreter_ms': round(statistics.median(
+                interpreter_seconds() for _ in range(args.runs)) * 1000, 2),
+            'cold': medians([run_child(env, 'cold') for _ in range(args.runs)]),
+            'warm': medians([run_child(env, 'warm') for _ in range(args.runs)]),
+            'gunicorn': medians([server_startup(env, args.port, token)
+                                 for _ in range(args.runs)]),
+            'slowest_imports': import_profile(env, args.top)
+        }
+    finally:
+        jwks_server.shutdown()
+
+    print('python startup     %8.2f ms' % report['interpreter_ms'])
+    for mode in ('cold', 'warm', 'gunicorn'):
+        for name, value in report[mode].items():
+            print('%-8s %-18s %8.2f ms' % (mode, name, value))
+    print('slowest imports (cumulative):')
+    for item in report['slowest_imports']:
+        print('  %8.2f ms  %s' % (item['cumulative_ms'], item['module']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from config import settings
+from models import db, Actor, Movie, Performance
+
+
+'''
+Bulk inserts
+
+The bulk routes validate every record before touching the database and
+then write all of them in one transaction, BULK_BATCH_SIZE rows per
+multi-row INSERT statement. The ids are taken from the sequence up front
+and assigned in input order, since the order of RETURNING rows is not
+guaranteed. A batch the database rejects is rolled back as a whole and
+reported with 422 and the same per-item errors as validation.
+'''
+
+
+'''
+validate_movie(item) / validate_actor(item)
+Return the row to insert, or raise ValueError with a message for the
+client. The release dates are left for PostgreSQL to parse, see
+views.parse_release_dates().
+'''
+def validate_movie(item):
+    if not isinstance(item, dict):
+        raise ValueError('Expected an object.')
+    title = item.get('title')
+    if not isinstance(title, str) or not title.strip():
+        raise ValueError('title is required.')
+    release_date = item.get('release_date')
+    if not isinstance(release_date, str):
+        raise ValueError('release_date is required.')
+    return {'title': title, 'release_date': release_date}
+
+
+def validate_actor(item):
+    if not isinstance(item, dict):
+        raise ValueError('Expected an object.')
+    name = item.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required.')
+    age = item.get('age')
+    if not isinstance(age, int) or isinstance(age, bool) or age < 0:
+        raise ValueError('age must be a non-negative integer.')
+    gender = item.get('gender')
+    if not isinstance(gender, str) or not gender.strip():
+        raise ValueError('gender is required.')
+    return {'name': name, 'age': age, 'gender': gender}
+
+
+def validate_casting(item):
+    if not isinstance(item, dict):
+        raise ValueError('Expected an object.')
+    for field in ('actor_id', 'movie_id'):
+        value = item.get(field)
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError('%s must be an integer.' % field)
+    return (item['actor_id'], item['movie_id'])
+
+
+'''
+validate_all(items, validate)
+Returns (rows, errors), errors being a list of {"index", "message"}.
+'''
+def validate_all(items, validate):
+    if not isinstance(items, list) or not items:
+        return [], [{'index': None, 'message': 'Expected a non-empty array.'}]
+    if len(items) > settings.BULK_MAX_ITEMS:
+        return [], [{
+            'index': None,
+            'message': 'At most %d records per request.' % settings.BULK_MAX_ITEMS
+        }]
+
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(validate(item))
+        except ValueError as e:
+            errors.append({'index': index, 'message': str(e)})
+    return rows, errors
+
+
+'''
+reserve_ids(session, table, n)
+Takes `n` ids from the sequence of `table` in one round trip, in ascending
+order.
+'''
+def reserve_ids(session, table, n):
+    result = session.execute(text(
+        "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+        "FROM generate_series(1, :n)"), {'table': table, 'n': n})
+    return sorted(row[0] for row in result)
+
+
+'''
+bulk_insert(table, rows)
+Inserts `rows` into `table` in the current transaction and returns the new
+ids, the i-th id being the one of the i-th row. The caller commits.
+`session` defaults to db.session.
+'''
+def bulk_insert(table, rows, session=None):
+    session = session or db.session
+    ids = reserve_ids(session, table.name, len(rows))
+    rows = [dict(row, id=id) for row, id in zip(rows, ids)]
+    size = settings.BULK_BATCH_SIZE
+    for start in range(0, len(rows), size):
+        session.execute(table.insert().values(rows[start:start + size]))
+    return ids
+
+
+'''
+insert_castings(pairs)
+Inserts (actor_id, movie_id) pairs with INSERT ... ON CONFLICT DO NOTHING
+against the unique (actor_id, movie_id) constraint, so pairs that already
+exist are skipped without a lookup and without racing concurrent inserts.
+Returns the set of pairs that were actually created. The caller commits.
+'''
+def insert_castings(pairs, session=None):
+    session = session or db.session
+    created = set()
+    unique_pairs = list(dict.fromkeys(pairs))
+    size = settings.BULK_BATCH_SIZE
+    for start in range(0, len(unique_pairs), size):
+        statement = pg_insert(Performance).values([
+            {'actor_id': actor_id, 'movie_id': movie_id}
+            for actor_id, movie_id in unique_pairs[start:start + size]
+        ]).on_conflict_do_nothing(
+            index_elements=['actor_id', 'movie_id']
+        ).returning(Performance.c.actor_id, Performance.c.movie_id)
+        created.update(
+            (row.actor_id, row.movie_id) for row in session.execute(statement))
+    return created
+
+
+'''
+integrity_errors(error, pairs=None)
+The errors to report for a batch the database rejected with `error`, in
+the format of validate_all(). For castings, the `pairs` whose actor or
+movie does not exist, by index. Otherwise, or when none is missing, the
+constraint that failed, with index None. Run it after the rollback.
+'''
+def integrity_errors(error, pairs=None, session=None):
+    session = session or db.session
+    errors = []
+    if pairs:
+        actors = set(session.scalars(
+            select(Actor.id).where(Actor.id.in_({a for a, _ in pairs}))))
+        movies = set(session.scalars(
+            select(Movie.id).where(Movie.id.in_({m for _, m in pairs}))))
+        for index, (actor_id, movie_id) in enumerate(pairs):
+            if actor_id not in actors:
+                errors.append({'index': index,
+                               'message': 'actor_id %d does not exist.' % actor_id})
+            elif movie_id not in movies:
+                errors.append({'index': index,
+                               'message': 'movie_id %d does not exist.' % movie_id})
+    if not errors:
+        # psycopg2 has the server message in diag, asyncpg on the exception
+        # it was translated from
+        diag = getattr(error.orig, 'diag', None)
+        message = (getattr(diag, 'message_primary', None) or
+                   getattr(error.orig.__cause__, 'message', None))
+        errors.append({'index': None,
+                       'message': message or 'The records conflict with existing data.'})
+    return errors
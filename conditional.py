@@ -0,0 +1,50 @@
+import hashlib
+from flask import Response, g, make_response, request
+from functools import wraps
+
+from models import get_versions
+
+
+'''
+Conditional GET
+
+conditional(*tables) tags successful responses with a strong ETag built
+from the change versions of the tables the view reads, plus the request path
+and args. A request whose If-None-Match carries the current ETag gets a 304
+straight away, before the view runs, so nothing is queried or serialized.
+
+Put it below requires_auth so a 304 is only ever sent to an authorized
+caller. The versions are left in `g.change_versions` for the response cache.
+'''
+
+
+'''
+make_etag(versions, request)
+The ETag of `request` at `versions`. `request` defaults to Flask's, asgi.py
+passes Quart's.
+'''
+def make_etag(versions, request=request):
+    parts = [request.path]
+    parts.extend('%s=%s' % item for item in sorted(request.args.items(multi=True)))
+    parts.extend(str(version) for version in versions)
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g.change_versions = get_versions(*tables)
+            etag = make_etag(g.change_versions)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
@@ -3,27 +3,122 @@ from dotenv import load_dotenv
 
 from pathlib import Path
 env_path = Path('.') / '.env'
-load_dotenv(dotenv_path=env_path)
 
+
+'''
+Settings
+
+Read from the environment, and from .env in the working directory, the
+first time a setting is used rather than when this module is imported, so
+importing the app or a helper module has no side effects. The values are
+fixed from then on.
+'''
 class Settings:
 
-    #POSTGRES_USER : str = os.getenv("POSTGRES_USER")
-    #POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
-    #POSTGRES_SERVER : str = os.getenv("POSTGRES_SERVER","localhost")
-    #POSTGRES_PORT : str = os.getenv("POSTGRES_PORT",5432) # default postgres port is 5432
-    #POSTGRES_DB : str = os.getenv("POSTGRES_DB","tdd")
-    #DATABASE_URI = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
-
-    AUTH0_DOMAIN : str = os.getenv("AUTH0_DOMAIN")
-    AUTH0_CLIENT_ID : str = os.getenv("AUTH0_CLIENT_ID")
-    AUTH0_CLIENT_SECRET : str = os.getenv("AUTH0_CLIENT_SECRET")
-    ALGORITHMS : str = os.getenv("ALGORITHMS")
-    API_AUDIENCE = str = os.getenv("API_AUDIENCE")
-    BASE_URL = os.getenv("BASE_URL")
-
-    PRODUCER = str = os.getenv("PRODUCER")
-    DIRECTOR = str = os.getenv("DIRECTOR")
-    ASSISTANT = str = os.getenv("ASSISTANT")
-    POSTGRES_DB_TEST : str = os.getenv("POSTGRES_DB_TEST","tdd")
-
-settings = Settings()
+    def __init__(self):
+        #POSTGRES_USER : str = os.getenv("POSTGRES_USER")
+        #POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
+        #POSTGRES_SERVER : str = os.getenv("POSTGRES_SERVER","localhost")
+        #POSTGRES_PORT : str = os.getenv("POSTGRES_PORT",5432) # default postgres port is 5432
+        #POSTGRES_DB : str = os.getenv("POSTGRES_DB","tdd")
+        #DATABASE_URI = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+        self.AUTH0_DOMAIN : str = os.getenv("AUTH0_DOMAIN")
+        self.AUTH0_CLIENT_ID : str = os.getenv("AUTH0_CLIENT_ID")
+        self.AUTH0_CLIENT_SECRET : str = os.getenv("AUTH0_CLIENT_SECRET")
+        self.ALGORITHMS : str = os.getenv("ALGORITHMS")
+        self.API_AUDIENCE : str = os.getenv("API_AUDIENCE")
+        self.BASE_URL : str = os.getenv("BASE_URL")
+
+        self.PRODUCER : str = os.getenv("PRODUCER")
+        self.DIRECTOR : str = os.getenv("DIRECTOR")
+        self.ASSISTANT : str = os.getenv("ASSISTANT")
+        self.POSTGRES_DB_TEST : str = os.getenv("POSTGRES_DB_TEST","tdd")
+
+        # JWKS key store
+        self.JWKS_URL : str = os.getenv("JWKS_URL")
+        self.JWKS_FILE : str = os.getenv("JWKS_FILE")
+        self.JWKS_CACHE_TTL : int = int(os.getenv("JWKS_CACHE_TTL", 600))
+        self.JWKS_REFRESH_MARGIN : int = int(os.getenv("JWKS_REFRESH_MARGIN", 60))
+        self.JWKS_MIN_REFETCH_INTERVAL : int = int(os.getenv("JWKS_MIN_REFETCH_INTERVAL", 30))
+
+        # Verified token cache, 0 disables it
+        self.TOKEN_CACHE_SIZE : int = int(os.getenv("TOKEN_CACHE_SIZE", 1024))
+
+        # Collection pagination
+        self.PAGE_SIZE : int = int(os.getenv("PAGE_SIZE", 100))
+        self.MAX_PAGE_SIZE : int = int(os.getenv("MAX_PAGE_SIZE", 1000))
+        self.COUNT_ESTIMATE_THRESHOLD : int = int(os.getenv("COUNT_ESTIMATE_THRESHOLD", 100000))
+
+        # Rows fetched per server-side cursor round trip in streamed listings
+        self.STREAM_CHUNK_SIZE : int = int(os.getenv("STREAM_CHUNK_SIZE", 500))
+
+        # Response cache for read routes: memory, redis or none
+        self.RESPONSE_CACHE_BACKEND : str = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+        self.RESPONSE_CACHE_MAX_BYTES : int = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+        self.RESPONSE_CACHE_REDIS_URL : str = os.getenv("RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0")
+        self.RESPONSE_CACHE_TTL : int = int(os.getenv("RESPONSE_CACHE_TTL", 300))
+
+        # Coalesce concurrent identical misses of the response cache: memory
+        # (within a process, only useful with threaded workers), redis
+        # (across workers, with the redis response cache) or none. Waiting
+        # requests give up after the timeout.
+        self.SINGLE_FLIGHT : str = os.getenv("SINGLE_FLIGHT", "none")
+        self.SINGLE_FLIGHT_TIMEOUT : float = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", 10))
+
+        # Response JSON encoder: orjson (falls back to json when not installed) or json
+        self.JSON_PROVIDER : str = os.getenv("JSON_PROVIDER", "orjson")
+
+        # Bulk create routes
+        self.BULK_MAX_ITEMS : int = int(os.getenv("BULK_MAX_ITEMS", 10000))
+        self.BULK_BATCH_SIZE : int = int(os.getenv("BULK_BATCH_SIZE", 1000))
+
+        # Primary database, postgres:// URLs are accepted too
+        self.DATABASE_URL : str = os.getenv("DATABASE_URL")
+
+        # Database connection pool, sized per worker process
+        self.DB_POOL_SIZE : int = int(os.getenv("DB_POOL_SIZE", 5))
+        self.DB_MAX_OVERFLOW : int = int(os.getenv("DB_MAX_OVERFLOW", 5))
+        self.DB_POOL_TIMEOUT : int = int(os.getenv("DB_POOL_TIMEOUT", 10))
+        self.DB_POOL_RECYCLE : int = int(os.getenv("DB_POOL_RECYCLE", 1800))
+        self.DB_POOL_PRE_PING : bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+        # Server-side statement_timeout in milliseconds, 0 disables it
+        self.DB_STATEMENT_TIMEOUT_MS : int = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 15000))
+
+        # Optional read replica for GET routes
+        self.DATABASE_REPLICA_URL : str = os.getenv("DATABASE_REPLICA_URL")
+        self.REPLICA_RETRY_INTERVAL : int = int(os.getenv("REPLICA_RETRY_INTERVAL", 30))
+
+        # Token bucket rate limit per token subject and permission: memory,
+        # redis or none. RATE_LIMIT_RATE requests per second with bursts of
+        # RATE_LIMIT_BURST, and per permission overrides in RATE_LIMITS, e.g.
+        # "get:performance=2/5,post:performance=0.5/2"
+        self.RATE_LIMIT_BACKEND : str = os.getenv("RATE_LIMIT_BACKEND", "none")
+        self.RATE_LIMIT_RATE : float = float(os.getenv("RATE_LIMIT_RATE", 10))
+        self.RATE_LIMIT_BURST : int = int(os.getenv("RATE_LIMIT_BURST", 20))
+        self.RATE_LIMITS : str = os.getenv("RATE_LIMITS", "")
+        self.RATE_LIMIT_REDIS_URL : str = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+        self.RATE_LIMIT_MAX_KEYS : int = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+
+        # Serve castings from the denormalized casting_details table
+        self.CASTING_READ_MODEL : bool = os.getenv("CASTING_READ_MODEL", "false").lower() == "true"
+
+
+'''
+LazySettings
+Builds Settings on the first attribute access and serves every later one
+from its own __dict__.
+'''
+class LazySettings:
+
+    def __getattr__(self, name):
+        if name.startswith('__') or self.__dict__:
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+    def load(self):
+        load_dotenv(dotenv_path=env_path)
+        self.__dict__.update(vars(Settings()))
+
+settings = LazySettings()
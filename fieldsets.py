@@ -0,0 +1,82 @@
+from sqlalchemy.orm import load_only, selectinload
+
+from models import Movie, Actor
+
+
+'''
+Sparse fieldsets and includes
+
+  /movies?fields=title&include=actors
+  /actors?fields=name,age&include=movies
+
+`fields` lists the columns to return besides the id, and only those
+columns are selected (load_only). `include` opts into the related records:
+the cast of each movie, or the castings of each actor, loaded in one extra
+query for the whole page. A listing asked for `fields` or `include` returns
+nothing else; without either it keeps its full shape, relations included.
+
+The single resource routes take `include` too, and load the related
+records in the same query as the resource.
+
+All functions raise ValueError on unknown names.
+'''
+
+
+def parse_names(value, allowed):
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    for name in names:
+        if name not in allowed:
+            raise ValueError('Unknown name %s.' % name)
+    return tuple(dict.fromkeys(names))
+
+
+'''
+fieldset(args, model, relation)
+Returns (fields, include) for a listing of `model`, include being whether
+`relation` was asked for.
+'''
+def fieldset(args, model, relation):
+    fields = args.get('fields')
+    include = args.get('include')
+    if fields is None and include is None:
+        return model.LISTING_FIELDS, True
+
+    if fields is not None:
+        fields = parse_names(fields, model.LISTING_FIELDS)
+    else:
+        fields = model.LISTING_FIELDS
+    return fields, relation in parse_names(include or '', (relation,))
+
+
+def movie_fieldset(args):
+    return fieldset(args, Movie, 'actors')
+
+
+def actor_fieldset(args):
+    return fieldset(args, Actor, 'movies')
+
+
+'''
+movie_options(fields, cast) / actor_options(fields, castings)
+Loader options that read only what the listing will return.
+'''
+def movie_options(fields, cast):
+    options = [load_only(Movie.id, *[getattr(Movie, name) for name in fields])]
+    if cast:
+        options.append(selectinload(Movie.actor))
+    return options
+
+
+def actor_options(fields, castings):
+    options = [load_only(Actor.id, *[getattr(Actor, name) for name in fields])]
+    if castings:
+        options.append(selectinload(Actor.movies))
+    return options
+
+
+'''
+includes(args, relation)
+Whether a single resource route was asked to include `relation`.
+'''
+def includes(args, relation):
+    return relation in parse_names(args.get('include', ''), (relation,))
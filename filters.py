@@ -0,0 +1,64 @@
+from datetime import datetime
+
+from models import Movie, Actor
+
+
+'''
+Listing filters
+
+Turn search query args into SQL predicates, so filtering happens in the
+database instead of in the client.
+
+  /movies?title=&released_after=&released_before=
+  /actors?name=&age_min=&age_max=&gender=
+
+`title` and `name` are case-insensitive substring matches, served by the
+pg_trgm GIN indexes from migration 5d2b8f1c7a90 where the extension is
+available. `released_after` is inclusive and `released_before` exclusive.
+All functions raise ValueError on malformed values.
+'''
+
+
+def contains(column, value):
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return column.ilike('%' + escaped + '%', escape='\\')
+
+
+def parse_date(value):
+    return datetime.fromisoformat(value)
+
+
+def parse_age(value):
+    age = int(value)
+    if age < 0:
+        raise ValueError('Invalid age.')
+    return age
+
+
+def release_filters(args):
+    filters = []
+    if args.get('released_after'):
+        filters.append(Movie.release_date >= parse_date(args['released_after']))
+    if args.get('released_before'):
+        filters.append(Movie.release_date < parse_date(args['released_before']))
+    return filters
+
+
+def movie_filters(args):
+    filters = []
+    if args.get('title'):
+        filters.append(contains(Movie.title, args['title']))
+    return filters + release_filters(args)
+
+
+def actor_filters(args):
+    filters = []
+    if args.get('name'):
+        filters.append(contains(Actor.name, args['name']))
+    if args.get('gender'):
+        filters.append(Actor.gender == args['gender'])
+    if args.get('age_min'):
+        filters.append(Actor.age >= parse_age(args['age_min']))
+    if args.get('age_max'):
+        filters.append(Actor.age <= parse_age(args['age_max']))
+    return filters
@@ -0,0 +1,19 @@
+# Loaded automatically by gunicorn from the working directory.
+
+
+def child_exit(server, worker):
+    # Drop the live gauges of a finished worker from /metrics when metrics
+    # are shared between workers through PROMETHEUS_MULTIPROC_DIR
+    import os
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # Connect to the database and fetch the signing keys before the worker
+    # takes its first request
+    from flask import Flask
+    if isinstance(worker.wsgi, Flask):
+        from app import warm_up
+        warm_up(worker.wsgi)
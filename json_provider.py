@@ -0,0 +1,108 @@
+import re
+from datetime import datetime
+from functools import lru_cache
+from flask.json.provider import DefaultJSONProvider
+
+from config import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+JSON provider
+
+Serializes responses with orjson when it is installed, and with the
+standard library otherwise (or with JSON_PROVIDER=json). Either way
+datetimes are written in the API's date format, so views and models hand
+over raw datetimes instead of calling strftime for every row. Dataclass
+rows are serialized without an intermediate dict, natively by orjson.
+
+Formatted dates are cached: a listing repeats the same few release dates
+many times, and strftime is the slow part.
+'''
+
+DATE_FORMAT = "%B %d %Y %H:%M:%S"
+NON_ASCII = re.compile('[^\x00-\x7f]')
+
+
+@lru_cache(maxsize=4096)
+def format_datetime(value):
+    return value.strftime(DATE_FORMAT)
+
+
+'''
+escape_non_ascii(text)
+Writes non-ASCII characters as \\u escapes, as json.dumps does with
+ensure_ascii. orjson only emits raw UTF-8, and outside strings JSON is
+always ASCII, so every match is inside a string.
+'''
+def escape_non_ascii(text):
+    return NON_ASCII.sub(escape_char, text)
+
+
+def escape_char(match):
+    code = ord(match.group())
+    if code < 0x10000:
+        return '\\u%04x' % code
+    code -= 0x10000
+    return '\\u%04x\\u%04x' % (0xd800 + (code >> 10), 0xdc00 + (code & 0x3ff))
+
+
+def json_default(o):
+    if isinstance(o, datetime):
+        return format_datetime(o)
+    return DefaultJSONProvider.default(o)
+
+
+'''
+FastJSONMixin
+Mixed into the framework's default provider, which it falls back to for
+anything orjson is not used for. Shared by app.py and asgi.py.
+'''
+class FastJSONMixin:
+    default = staticmethod(json_default)
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.use_orjson = orjson is not None and settings.JSON_PROVIDER == 'orjson'
+
+    def dumps(self, obj, **kwargs):
+        if not self.use_orjson:
+            return super().dumps(obj, **kwargs)
+        return self.dumpb(obj, **kwargs).decode('utf-8')
+
+    # `separators` does not apply: orjson output is always compact. With
+    # ensure_ascii, the provider's default, the rare bodies that are not
+    # plain ASCII are escaped afterwards, so they match the json module's
+    # byte for byte.
+    def dumpb(self, obj, indent=None, sort_keys=None, ensure_ascii=None, **kwargs):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        body = orjson.dumps(obj, default=self.default, option=option)
+        if self.ensure_ascii if ensure_ascii is None else ensure_ascii:
+            if not body.isascii():
+                body = escape_non_ascii(body.decode('utf-8')).encode('ascii')
+        return body
+
+    def loads(self, s, **kwargs):
+        if not self.use_orjson or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if not self.use_orjson:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(
+            self.dumpb(obj, indent=indent) + b"\n", mimetype=self.mimetype)
+
+
+class FastJSONProvider(FastJSONMixin, DefaultJSONProvider):
+    pass
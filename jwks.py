@@ -0,0 +1,236 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+from urllib.request import urlopen
+
+from metrics import JWKS_FETCHES
+
+
+'''
+JWKSKeyStore
+In-process store for the signing keys published by the identity provider.
+
+Keys are fetched once and indexed by `kid`. They are refreshed in the
+background shortly before `ttl` runs out, and refetched (at most once per
+`min_refetch_interval`) when a token presents a `kid` we have not seen yet,
+which is what happens when the provider rotates its keys. If a refresh fails
+the last known keys keep being served, so a provider outage does not take the
+API down with it.
+
+Pass `jwks_file` to start from a local JWKS document. Without a `url` the
+store never touches the network, which is what offline and test runs want.
+'''
+class JWKSKeyStore:
+
+    def __init__(self, url=None, jwks_file=None, ttl=600, refresh_margin=60,
+                 min_refetch_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl)
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+        if jwks_file:
+            with open(jwks_file) as f:
+                self._store(json.load(f))
+
+    '''
+    get_key(kid)
+    Returns the RSA key for `kid` in the shape `jwt.decode` expects, or None.
+    '''
+    def get_key(self, kid):
+        now = time.monotonic()
+        if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+            self._refetch()
+        elif now - self._fetched_at >= self.ttl - self.refresh_margin:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        self._refetch()
+        return self._keys.get(kid)
+
+    '''
+    refresh()
+    Fetches the JWKS document and swaps in the new key set. Returns True on
+    success. Failures are counted and the current keys are kept.
+    '''
+    def refresh(self):
+        if not self.url:
+            return False
+        with self._lock:
+            return self._fetch()
+
+    '''
+    has_keys
+    True once a key set has been loaded, from the file or the provider.
+    '''
+    @property
+    def has_keys(self):
+        return bool(self._keys)
+
+    def stats(self):
+        return {
+            'keys': len(self._keys),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_failures': self.refresh_failures
+        }
+
+    def _store(self, jwks):
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def _fetch(self):
+        self._last_attempt = time.monotonic()
+        try:
+            with urlopen(self.url, timeout=self.timeout) as response:
+                jwks = json.loads(response.read())
+            self._store(jwks)
+            self.refreshes += 1
+            JWKS_FETCHES.labels('success').inc()
+            return True
+        except Exception:
+            self.refresh_failures += 1
+            JWKS_FETCHES.labels('failure').inc()
+            print(sys.exc_info())
+            return False
+
+    # Rate limited: concurrent callers that lose the race, and callers that
+    # arrive within `min_refetch_interval` of the last attempt, reuse its
+    # outcome instead of hitting the provider again.
+    def _refetch(self):
+        if not self.url:
+            return False
+        with self._lock:
+            if (self._last_attempt is not None and
+                    time.monotonic() - self._last_attempt < self.min_refetch_interval):
+                return False
+            return self._fetch()
+
+    def _refresh_in_background(self):
+        if not self.url or self._refreshing:
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self._refetch()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+
+'''
+AsyncJWKSKeyStore
+The same store for the ASGI app (asgi.py): keys are fetched with httpx on
+the event loop instead of blocking a worker in urlopen, and the background
+refresh runs as a task instead of a thread. The caching, rate limiting and
+stale-key policy are the ones above.
+'''
+class AsyncJWKSKeyStore(JWKSKeyStore):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_lock = asyncio.Lock()
+        self._client = None
+        self._task = None
+
+    async def get_key(self, kid):
+        now = time.monotonic()
+        if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+            await self._refetch()
+        elif now - self._fetched_at >= self.ttl - self.refresh_margin:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        await self._refetch()
+        return self._keys.get(kid)
+
+    async def refresh(self):
+        if not self.url:
+            return False
+        async with self._async_lock:
+            return await self._fetch()
+
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _fetch(self):
+        import httpx
+
+        self._last_attempt = time.monotonic()
+        try:
+            if self._client is None:
+                self._client = httpx.AsyncClient(timeout=self.timeout)
+            response = await self._client.get(self.url)
+            response.raise_for_status()
+            self._store(response.json())
+            self.refreshes += 1
+            JWKS_FETCHES.labels('success').inc()
+            return True
+        except Exception:
+            self.refresh_failures += 1
+            JWKS_FETCHES.labels('failure').inc()
+            print(sys.exc_info())
+            return False
+
+    async def _refetch(self):
+        if not self.url:
+            return False
+        async with self._async_lock:
+            if (self._last_attempt is not None and
+                    time.monotonic() - self._last_attempt < self.min_refetch_interval):
+                return False
+            return await self._fetch()
+
+    def _refresh_in_background(self):
+        if not self.url or self._refreshing:
+            return
+        self._refreshing = True
+
+        async def run():
+            try:
+                await self._refetch()
+            finally:
+                self._refreshing = False
+
+        self._task = asyncio.get_running_loop().create_task(run())
@@ -1,14 +1,13 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+from flask.cli import FlaskGroup
 
-from app import app
-from models import db
+from app import create_app
 
-migrate = Migrate(app, db)
-manager = Manager(app)
-
-manager.add_command('db', MigrateCommand)
+'''
+Management commands, e.g. `python manage.py db upgrade`, the same as
+`flask --app app db upgrade`. The app is only created once a command runs.
+'''
+cli = FlaskGroup(create_app=create_app)
 
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    cli()
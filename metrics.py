@@ -0,0 +1,215 @@
+import os
+import time
+from contextvars import ContextVar
+from flask import Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter,
+                               Gauge, Histogram, REGISTRY, generate_latest)
+from prometheus_client import multiprocess
+
+
+'''
+Metrics
+
+Prometheus metrics for the API, served by GET /metrics.
+
+Under gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by
+the workers; every worker then writes its samples there and /metrics
+aggregates all of them, whichever worker answers the scrape.
+
+Request metrics are labelled with the route rule (/movies/<movie_id>), not
+the path, so the number of series stays fixed. Durations are measured
+until the view returns; the body of a streamed response is not included.
+'''
+
+# Connection pool, labelled with the primary or replica pool
+
+POOL_CHECKOUT_SECONDS = Histogram(
+    'db_pool_checkout_seconds',
+    'Time spent waiting for a connection from the pool.',
+    ['pool'],
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 30)
+)
+POOL_CHECKOUT_TIMEOUTS = Counter(
+    'db_pool_checkout_timeouts_total',
+    'Checkouts that gave up after DB_POOL_TIMEOUT seconds.',
+    ['pool']
+)
+POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out',
+    'Connections currently checked out of the pool.',
+    ['pool'],
+    multiprocess_mode='livesum'
+)
+POOL_CAPACITY = Gauge(
+    'db_pool_capacity',
+    'Pool size plus max overflow.',
+    ['pool'],
+    multiprocess_mode='livesum'
+)
+POOL_SATURATION = Gauge(
+    'db_pool_saturation',
+    'Checked out connections over capacity, highest across workers.',
+    ['pool'],
+    multiprocess_mode='livemax'
+)
+
+# Requests
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'Time to build the response, by route.',
+    ['method', 'route'],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+HTTP_RESPONSES = Counter(
+    'http_responses_total',
+    'Responses by route and status code.',
+    ['method', 'route', 'status']
+)
+HTTP_IN_FLIGHT = Gauge(
+    'http_requests_in_flight',
+    'Requests being handled.',
+    multiprocess_mode='livesum'
+)
+DB_STATEMENTS = Histogram(
+    'db_statements_per_request',
+    'SQL statements executed while handling a request.',
+    ['route'],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100)
+)
+DB_SECONDS = Histogram(
+    'db_seconds_per_request',
+    'Time spent executing SQL while handling a request.',
+    ['route'],
+    buckets=(.0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 5)
+)
+
+# Response cache
+
+SINGLE_FLIGHT_SHARED = Counter(
+    'single_flight_shared_total',
+    'Requests answered with the body of an identical request in flight, by scope.',
+    ['scope']
+)
+
+# Auth
+
+JWT_VERIFY_SECONDS = Histogram(
+    'jwt_verify_seconds',
+    'Time to verify a bearer token, from the token cache or by signature.',
+    ['source'],
+    buckets=(.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1)
+)
+JWKS_FETCHES = Counter(
+    'jwks_fetches_total',
+    'JWKS documents requested from the identity provider.',
+    ['result']
+)
+RATE_LIMITED = Counter(
+    'rate_limited_total',
+    'Requests rejected with 429 by the rate limit, by permission.',
+    ['permission']
+)
+
+
+'''
+Per-request state: [start, statements, db seconds, start of the running
+statement], or None outside a request. A ContextVar, so it follows the request both in a gunicorn thread
+and in an asyncio task.
+'''
+_request_stats = ContextVar('request_stats', default=None)
+
+
+# Labelled children by (method, route, status): looking them up through
+# labels() on every request costs more than the observations themselves
+_children = {}
+
+def labelled(method, route, status):
+    return (
+        HTTP_REQUEST_SECONDS.labels(method, route),
+        HTTP_RESPONSES.labels(method, route, str(status)),
+        DB_STATEMENTS.labels(route),
+        DB_SECONDS.labels(route)
+    )
+
+
+def start_request():
+    HTTP_IN_FLIGHT.inc()
+    _request_stats.set([time.perf_counter(), 0, 0.0, 0.0])
+
+
+def finish_request(request, status):
+    stats = _request_stats.get()
+    if stats is None:
+        return
+    elapsed = time.perf_counter() - stats[0]
+    rule = request.url_rule
+    key = (request.method, rule.rule if rule is not None else 'unmatched', status)
+    children = _children.get(key)
+    if children is None:
+        children = _children[key] = labelled(*key)
+    latency, responses, statements, db_seconds = children
+    latency.observe(elapsed)
+    responses.inc()
+    statements.observe(stats[1])
+    db_seconds.observe(stats[2])
+
+
+def end_request():
+    if _request_stats.get() is not None:
+        HTTP_IN_FLIGHT.dec()
+        _request_stats.set(None)
+
+
+'''
+track_requests(app)
+Records the request metrics for every request of a Flask app. asgi.py
+calls the same three functions from its own hooks.
+'''
+def track_requests(app):
+
+    @app.before_request
+    def start_request_metrics():
+        start_request()
+
+    @app.after_request
+    def record_request_metrics(response):
+        finish_request(request, response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exception=None):
+        end_request()
+
+
+# Every engine, the replica's and the async app's included. Statements run
+# outside a request are not counted. A request runs one statement at a
+# time, so the start of the current one is kept with the request.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats[3] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats[1] += 1
+        stats[2] += time.perf_counter() - stats[3]
+
+
+def metrics_payload():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def metrics_response():
+    return Response(metrics_payload(), mimetype=CONTENT_TYPE_LATEST)
@@ -7,6 +7,8 @@ from flask import current_app
 
 from alembic import context
 
+from models import lift_statement_timeout
+
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -78,6 +80,7 @@ def run_migrations_online():
                 logger.info('No changes in schema detected.')
 
     connectable = current_app.extensions['migrate'].db.get_engine()
+    lift_statement_timeout(connectable)
 
     with connectable.connect() as connection:
         context.configure(
@@ -0,0 +1,40 @@
+"""indexes for joins, cascade deletes and listing filters
+
+Revision ID: 0c36fe64684c
+Revises: 310041225f31
+Create Date: 2026-10-18 10:05:27.640912
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0c36fe64684c'
+down_revision = '310041225f31'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_performance_actor_id', 'performance', ['actor_id']),
+    ('ix_performance_movie_id', 'performance', ['movie_id']),
+    ('ix_movies_release_date', 'movies', ['release_date']),
+    ('ix_movies_title', 'movies', ['title']),
+    ('ix_actors_name', 'actors', ['name']),
+]
+
+
+def upgrade():
+    # Built concurrently so large tables stay writable while the indexes
+    # are created, which cannot happen inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
@@ -0,0 +1,31 @@
+"""unique (actor_id, movie_id) on performance
+
+Revision ID: 310041225f31
+Revises: 53669d94889e
+Create Date: 2026-10-18 09:40:03.218845
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '310041225f31'
+down_revision = '53669d94889e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Castings created before the constraint may contain duplicates, keep
+    # the oldest row of each pair
+    op.execute(
+        "DELETE FROM performance p USING performance q "
+        "WHERE p.actor_id = q.actor_id AND p.movie_id = q.movie_id "
+        "AND p.id > q.id"
+    )
+    op.create_unique_constraint(
+        'uq_performance_actor_movie', 'performance', ['actor_id', 'movie_id'])
+
+
+def downgrade():
+    op.drop_constraint('uq_performance_actor_movie', 'performance', type_='unique')
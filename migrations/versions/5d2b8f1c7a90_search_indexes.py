@@ -0,0 +1,75 @@
+"""trigram and range indexes for listing search
+
+Revision ID: 5d2b8f1c7a90
+Revises: 0c36fe64684c
+Create Date: 2026-10-18 10:48:19.022374
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+logger = logging.getLogger('alembic.env')
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2b8f1c7a90'
+down_revision = '0c36fe64684c'
+branch_labels = None
+depends_on = None
+
+
+TRIGRAM_INDEXES = [
+    ('ix_movies_title_trgm', 'movies', 'title'),
+    ('ix_actors_name_trgm', 'actors', 'name'),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'],
+                        unique=False, postgresql_concurrently=True)
+
+        # Substring search (ILIKE '%...%') can only use an index through
+        # pg_trgm. Where the extension is not available, or the migration
+        # role may not create it, the filters still work, just without
+        # index support.
+        available = op.get_bind().execute(sa.text(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+        )).scalar()
+        if available and create_trigram_extension():
+            for name, table, column in TRIGRAM_INDEXES:
+                op.create_index(name, table, [column], unique=False,
+                                postgresql_using='gin',
+                                postgresql_ops={column: 'gin_trgm_ops'},
+                                postgresql_concurrently=True)
+
+
+'''
+create_trigram_extension()
+Returns False, with a warning, when the role lacks the privilege. This runs
+in the autocommit block, so the failed statement leaves no transaction to
+roll back.
+'''
+def create_trigram_extension():
+    try:
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except sa.exc.DBAPIError as e:
+        if getattr(e.orig, 'pgcode', None) != '42501':  # insufficient_privilege
+            raise
+        logger.warning('Skipping the trigram indexes: this role may not create '
+                       'the pg_trgm extension. To add them, create it as a '
+                       'superuser, then run `flask db downgrade 0c36fe64684c` '
+                       'and `flask db upgrade`.')
+        return False
+    return True
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, column in TRIGRAM_INDEXES:
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+        op.drop_index('ix_actors_gender_age', table_name='actors',
+                      postgresql_concurrently=True)
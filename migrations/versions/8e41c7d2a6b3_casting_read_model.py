@@ -0,0 +1,50 @@
+"""denormalized casting read model
+
+Revision ID: 8e41c7d2a6b3
+Revises: 5d2b8f1c7a90
+Create Date: 2026-10-18 13:52:06.417583
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e41c7d2a6b3'
+down_revision = '5d2b8f1c7a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('casting_details',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('movie_title', sa.String(), nullable=False),
+    sa.Column('movie_release_date', sa.DateTime(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.Column('actor_name', sa.String(), nullable=False),
+    sa.Column('actor_age', sa.Integer(), nullable=False),
+    sa.Column('actor_gender', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['id'], ['performance.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_casting_details_movie_id', 'casting_details', ['movie_id'], unique=False)
+    op.create_index('ix_casting_details_actor_id', 'casting_details', ['actor_id'], unique=False)
+
+    # Filled from the existing castings, so the read model can be switched
+    # on right after upgrading
+    op.execute(
+        "INSERT INTO casting_details "
+        "SELECT p.id, p.movie_id, m.title, m.release_date, "
+        "       p.actor_id, a.name, a.age, a.gender "
+        "FROM performance p "
+        "JOIN movies m ON m.id = p.movie_id "
+        "JOIN actors a ON a.id = p.actor_id"
+    )
+
+
+def downgrade():
+    op.drop_index('ix_casting_details_actor_id', table_name='casting_details')
+    op.drop_index('ix_casting_details_movie_id', table_name='casting_details')
+    op.drop_table('casting_details')
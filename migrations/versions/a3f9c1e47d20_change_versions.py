@@ -0,0 +1,36 @@
+"""change version counters for conditional requests
+
+Revision ID: a3f9c1e47d20
+Revises: 8e41c7d2a6b3
+Create Date: 2026-10-18 16:05:37.218904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f9c1e47d20'
+down_revision = '8e41c7d2a6b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases built from the initial schema before this revision existed
+    # already have the table; stamped ones never got it
+    if not sa.inspect(op.get_bind()).has_table('change_versions'):
+        op.create_table('change_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+        )
+    op.execute(
+        "INSERT INTO change_versions (name, version) "
+        "VALUES ('movies', 0), ('actors', 0), ('performance', 0) "
+        "ON CONFLICT (name) DO NOTHING"
+    )
+
+
+def downgrade():
+    op.drop_table('change_versions')
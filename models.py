@@ -1,25 +1,168 @@
-import os
-from sqlalchemy import Column, String, Integer, create_engine, ARRAY, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, DateTime, DDL, Index, event
+from flask import g
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_migrate import Migrate
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 from datetime import datetime
-import json
+from functools import wraps
+import sys
+import time
 
 from config import settings
+from metrics import (POOL_CHECKOUT_SECONDS, POOL_CHECKOUT_TIMEOUTS, POOL_CHECKED_OUT,
+                     POOL_CAPACITY, POOL_SATURATION)
 
-database_path = ENV[‘DBURL’] 
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
+'''
+database_url(url)
+Normalizes the postgres:// scheme Heroku hands out, which SQLAlchemy no
+longer accepts.
+'''
+def database_url(url):
+    if url and url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
+def primary_url():
+    url = database_url(settings.DATABASE_URL)
+    if not url:
+        raise RuntimeError('DATABASE_URL is not set.')
+    return url
+
+
+def replica_url():
+    return database_url(settings.DATABASE_REPLICA_URL)
+
+
+'''
+RoutingSession
+
+Sends the reads of a @read_only route to the replica connection that the
+route checked out. Flushes and DML statements always go to the primary,
+and once a request has written anything its later reads do too, so it
+always reads its own writes.
+'''
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self.info.get('replica_connection')
+        if replica is not None and bind is None and not self.info.get('wrote'):
+            if self._flushing or getattr(clause, 'is_dml', False):
+                self.info['wrote'] = True
+            else:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
-db = SQLAlchemy()
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
 
+'''
+InstrumentedQueuePool
+QueuePool that records how long checkouts wait and how full the pool is,
+labelled with its `role`. ReplicaQueuePool is the pool of the replica.
+'''
+class InstrumentedQueuePool(QueuePool):
+    role = 'primary'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._capacity = self.size() + max(self._max_overflow, 0)
+        self._disposed = False
+        POOL_CAPACITY.labels(self.role).inc(self._capacity)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            POOL_CHECKOUT_TIMEOUTS.labels(self.role).inc()
+            raise
+        finally:
+            POOL_CHECKOUT_SECONDS.labels(self.role).observe(time.perf_counter() - start)
+        POOL_CHECKED_OUT.labels(self.role).inc()
+        self._record_saturation()
+        return connection
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        POOL_CHECKED_OUT.labels(self.role).dec()
+        self._record_saturation()
+
+    def dispose(self):
+        super().dispose()
+        if not self._disposed:
+            self._disposed = True
+            POOL_CAPACITY.labels(self.role).dec(self._capacity)
+
+    def _record_saturation(self):
+        if self._capacity:
+            POOL_SATURATION.labels(self.role).set(self.checkedout() / self._capacity)
+
+
+class ReplicaQueuePool(InstrumentedQueuePool):
+    role = 'replica'
+
+
+'''
+engine_options(database_path, poolclass)
+Pool sizing, recycling, pre-ping and the server-side statement timeout,
+all taken from config.Settings.
+'''
+def engine_options(database_path, poolclass=InstrumentedQueuePool):
+    options = {
+        'poolclass': poolclass,
+        'pool_size': settings.DB_POOL_SIZE,
+        'max_overflow': settings.DB_MAX_OVERFLOW,
+        'pool_timeout': settings.DB_POOL_TIMEOUT,
+        'pool_recycle': settings.DB_POOL_RECYCLE,
+        'pool_pre_ping': settings.DB_POOL_PRE_PING
+    }
+    if settings.DB_STATEMENT_TIMEOUT_MS and database_path.startswith("postgresql"):
+        options['connect_args'] = {
+            'options': '-c statement_timeout=%d' % settings.DB_STATEMENT_TIMEOUT_MS
+        }
+    return options
+
+
+'''
+lift_statement_timeout(engine)
+Turns DB_STATEMENT_TIMEOUT_MS off on every connection of `engine`. The
+maintenance commands (migrations, flask seed, flask read-model) call it
+first, since their statements run far longer than a request's.
+'''
+def lift_statement_timeout(engine):
+    if not event.contains(engine, 'connect', clear_statement_timeout):
+        event.listen(engine, 'connect', clear_statement_timeout, insert=True)
+    engine.dispose()
+
+
+def clear_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SET statement_timeout = 0')
+    cursor.close()
+    dbapi_connection.commit()
+
+
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. The URLs default to
+    DATABASE_URL and DATABASE_REPLICA_URL. The engines do not connect
+    until first used, or until app.warm_up().
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None, replica_path=None):
+    database_path = database_path or primary_url()
+    replica_path = replica_path or replica_url()
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    if replica_path:
+        app.config["SQLALCHEMY_BINDS"] = {
+            "replica": dict(engine_options(replica_path, ReplicaQueuePool), url=replica_path)
+        }
+        app.teardown_appcontext(release_replica)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["SECRET_KEY"] = '79537d00f4834892986f09a100aa1edf'
     db.app = app
@@ -29,65 +172,96 @@ def setup_db(app, database_path=database_path):
 
 
 '''
-drop_and_init_db()
-This will delete all entries and will create new ones.
-'''
-def drop_and_init_db(app):
-    with app.app_context():
-      db.drop_all()
-      db.create_all()
-
-      first_entry = Movie(
-        title="Rainy Temple",
-        release_date="2023-01-25 15:20:00",
-      )
-      first_entry.insert()
-
-      second_entry = Movie(
-        title="Messi's Way",
-        release_date="2023-01-25 15:20:00",
-      )
-      second_entry.insert()
-
-      third_entry = Movie(
-        title="Most Wanted",
-        release_date="2023-01-25 15:20:00",
-      )
-      third_entry.insert()
-
-      first_actor = Actor(
-          name='Arturo Valdes', 
-          age=26, 
-          gender='Male'
-          )
-      first_actor.insert()
-
-      second_actor = Actor(
-          name='Viki Jones', 
-          age=34, 
-          gender='Female'
-          )
-      second_actor.insert()
-
-      third_actor = Actor(
-          name='Goran Snipe', 
-          age=12, 
-          gender='Male'
-          )
-      third_actor.insert()
-
-      first_performance = Performance.insert().values(
-          actor_id=3, 
-          movie_id=1
-          )
-      
-      second_performance = Performance.insert().values(
-          actor_id=2, 
-          movie_id=2
-          )
-      db.session.execute(first_performance)
-      db.session.execute(second_performance)
-      db.session.commit()
+read_only
+Decorator for routes that only read. They run on the replica when one is
+configured and reachable, and on the primary otherwise. A replica that
+fails to hand out a connection is skipped for REPLICA_RETRY_INTERVAL
+seconds.
+'''
+replica_down_until = 0.0
+
+def read_only(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        global replica_down_until
+        engine = db.engines.get('replica')
+        if engine is not None and time.monotonic() >= replica_down_until:
+            try:
+                g.replica_connection = engine.connect()
+                db.session.info['replica_connection'] = g.replica_connection
+            except Exception:
+                replica_down_until = time.monotonic() + settings.REPLICA_RETRY_INTERVAL
+                print(sys.exc_info())
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def release_replica(exception=None):
+    connection = g.pop('replica_connection', None)
+    if connection is not None:
+        connection.close()
+
+
+'''
+release_session()
+Ends the transaction of db.session and hands its connections back to the
+pools, the replica connection of a @read_only route included. Later
+queries of the request run on the primary.
+'''
+def release_session():
+    db.session.close()
+    db.session.info.pop('replica_connection', None)
+    release_replica()
+
+
+'''
+ChangeVersion
+
+One counter per table, bumped in the same transaction as every write to
+that table. Conditional GETs compare against these instead of re-running
+the listing queries.
+'''
+class ChangeVersion(db.Model):
+    __tablename__ = 'change_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+VERSIONED_TABLES = ('movies', 'actors', 'performance')
+
+event.listen(ChangeVersion.__table__, 'after_create', DDL(
+    "INSERT INTO change_versions (name, version) VALUES " +
+    ", ".join("('%s', 0)" % name for name in VERSIONED_TABLES)
+))
+
+'''
+bump_versions(*tables)
+Increments the change counters of `tables` in the current transaction,
+creating missing ones, in a single upsert that concurrent writers cannot
+race on. `session` defaults to db.session.
+
+The counter row stays locked until the transaction ends, so writes to the
+same table are serialized from their bump to their commit. The write
+routes bump right before committing to keep that window short.
+'''
+def bump_versions(*tables, session=None):
+    session = session or db.session
+    for name in tables:
+        insert = pg_insert(ChangeVersion.__table__).values(name=name, version=1)
+        session.execute(insert.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'version': ChangeVersion.__table__.c.version + 1}))
+
+'''
+get_versions(*tables)
+Returns the current change counters of `tables` as a tuple, in order.
+'''
+def get_versions(*tables, session=None):
+    session = session or db.session
+    rows = dict(session.query(ChangeVersion.name, ChangeVersion.version)
+                .filter(ChangeVersion.name.in_(tables)).all())
+    return tuple(rows.get(name, 0) for name in tables)
 
 
 '''
@@ -98,10 +272,31 @@ This table associates the Movie model and the Actor model.
 
 Performance = db.Table('performance',
     db.Column('id', db.Integer, primary_key=True),
-    db.Column('actor_id', db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'), nullable=False),
-    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'), nullable=False)
+    db.Column('actor_id', db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'), nullable=False, index=True),
+    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'), nullable=False, index=True),
+    db.UniqueConstraint('actor_id', 'movie_id', name='uq_performance_actor_movie')
 )   
 
+'''
+CastingDetail
+
+Denormalized read model of performance: each casting already joined with
+its movie and actor, under the names the listings use. read_model.py keeps
+it in step with the normalized tables when CASTING_READ_MODEL is on.
+Deleting a casting, or the movie or actor it points to, cascades here
+through performance.
+'''
+CastingDetail = db.Table('casting_details',
+    db.Column('id', db.Integer, db.ForeignKey('performance.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('movie_id', db.Integer, nullable=False, index=True),
+    db.Column('movie_title', db.String, nullable=False),
+    db.Column('movie_release_date', db.DateTime, nullable=False),
+    db.Column('actor_id', db.Integer, nullable=False, index=True),
+    db.Column('actor_name', db.String, nullable=False),
+    db.Column('actor_age', db.Integer, nullable=False),
+    db.Column('actor_gender', db.String, nullable=False)
+)
+
 '''
 Actors
 '''
@@ -109,10 +304,17 @@ class Actor(db.Model):
     __tablename__ = 'actors'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String, nullable = False)
+    name = Column(String, nullable = False, index = True)
     age = Column(Integer, nullable = False)
     gender = Column(String, nullable = False)
 
+    # Serves gender and age range filters on /actors. The trigram indexes
+    # for name and title search live in migration 5d2b8f1c7a90 only, since
+    # they need the pg_trgm extension.
+    __table_args__ = (
+        Index('ix_actors_gender_age', 'gender', 'age'),
+    )
+
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
@@ -120,13 +322,16 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_versions('actors')
         db.session.commit()
     
     def update(self):
+        bump_versions('actors')
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_versions('actors', 'performance')
         db.session.commit()
 
     def format(self):
@@ -137,6 +342,35 @@ class Actor(db.Model):
         'gender': self.gender
         }
 
+    '''
+    Listing shape used by GET /actors: the actor's `fields`, plus the
+    castings unless `castings` is False. `related` maps actor ids to
+    castings already read from the read model, in place of the
+    relationship. Dates are left as datetimes for json_provider to format.
+    '''
+    LISTING_FIELDS = ('name', 'age', 'gender')
+
+    def format_listing(self, fields=LISTING_FIELDS, castings=True, related=None):
+        listing = {'actor_id': self.id}
+        for name in fields:
+            listing['actor_' + name] = getattr(self, name)
+        if castings:
+            if related is not None:
+                listing['casting:'] = related.get(self.id, [])
+            else:
+                listing['casting:'] = self.format_castings()
+        return listing
+
+    def format_castings(self):
+        return [
+            {
+                "movie_id": x.id,
+                "movie_title": x.title,
+                "movie_release_date": x.release_date
+            }
+            for x in self.movies
+        ]
+
 '''
 Movies
 '''
@@ -144,8 +378,8 @@ class Movie(db.Model):
   __tablename__ = 'movies'
 
   id = Column(Integer, primary_key=True)
-  title = Column(String, nullable = False)
-  release_date = Column(DateTime, default=datetime.now(), nullable=False)
+  title = Column(String, nullable = False, index = True)
+  release_date = Column(DateTime, default=datetime.now(), nullable=False, index=True)
   actor = db.relationship('Actor', secondary=Performance, lazy='select', backref=db.backref('movies', lazy=True))
 
   def __init__(self, title, release_date):
@@ -154,13 +388,16 @@ class Movie(db.Model):
 
   def insert(self):
     db.session.add(self)
+    bump_versions('movies')
     db.session.commit()
   
   def update(self):
+    bump_versions('movies')
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
+    bump_versions('movies', 'performance')
     db.session.commit()
 
   def format(self):
@@ -170,6 +407,36 @@ class Movie(db.Model):
       'release_date': self.release_date
     }
 
+  '''
+  Listing shape used by GET /movies: the movie's `fields`, plus the cast
+  unless `cast` is False. `related` maps movie ids to casts already read
+  from the read model, in place of the relationship. The release date is
+  left as a datetime for json_provider to format.
+  '''
+  LISTING_FIELDS = ('title', 'release_date')
+
+  def format_listing(self, fields=LISTING_FIELDS, cast=True, related=None):
+    listing = {'movie_id': self.id}
+    for name in fields:
+      listing['movie_' + name] = getattr(self, name)
+    if cast:
+      if related is not None:
+        listing['actors:'] = related.get(self.id, [])
+      else:
+        listing['actors:'] = self.format_cast()
+    return listing
+
+  def format_cast(self):
+    return [
+      {
+        "actor_id": x.id,
+        "actor_name": x.name,
+        "actor_age": x.age,
+        "actor_gender": x.gender
+      }
+      for x in self.actor
+    ]
+
 class Test(db.Model):
     __tablename__ = 'testactors'
 
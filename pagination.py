@@ -0,0 +1,105 @@
+import base64
+import json
+from sqlalchemy import func, select, text
+
+from config import settings
+
+
+'''
+Keyset pagination
+
+Collection endpoints accept `limit` and an opaque `cursor` and return the
+cursor for the following page as `next_cursor`. Pages are read with
+`WHERE id > :last_id ORDER BY id LIMIT :limit`, so every page costs the same
+no matter how deep into the table it is.
+
+Totals are opt-in through `total=exact` (a COUNT(*)) or `total=estimate`
+(the planner's row estimate on PostgreSQL, falling back to COUNT(*) for
+small tables where the estimate is unreliable).
+'''
+
+TOTAL_MODES = ('exact', 'estimate')
+
+
+def encode_cursor(last_id):
+    raw = json.dumps({'id': last_id}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+'''
+decode_cursor(cursor)
+Returns the last id seen by the previous page. Raises ValueError when the
+cursor was not produced by encode_cursor.
+'''
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded))['id']
+    except Exception:
+        raise ValueError('Invalid cursor.')
+    if not isinstance(last_id, int):
+        raise ValueError('Invalid cursor.')
+    return last_id
+
+
+'''
+page_args(args)
+Reads limit, cursor and total from the request args. Raises ValueError on
+malformed values.
+'''
+def page_args(args):
+    limit = int(args.get('limit', settings.PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('Invalid limit.')
+    limit = min(limit, settings.MAX_PAGE_SIZE)
+
+    cursor = args.get('cursor')
+    after_id = decode_cursor(cursor) if cursor else None
+
+    total = args.get('total')
+    if total in ('true', '1'):
+        total = 'exact'
+    if total is not None and total not in TOTAL_MODES:
+        raise ValueError('Invalid total.')
+
+    return limit, after_id, total
+
+
+'''
+paginate(query, key, limit, after_id)
+Applies the keyset predicate to `query` and returns the page rows together
+with the cursor of the next page, or None on the last page. `key_of` reads
+the key back from a row when the rows are not entities with an `id`.
+'''
+def paginate(query, key, limit, after_id, key_of=lambda row: row.id):
+    if after_id is not None:
+        query = query.filter(key > after_id)
+    rows = query.order_by(key).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(key_of(rows[-1]))
+    return rows, next_cursor
+
+
+'''
+count_rows(session, table, mode, filters)
+Counts the rows of `table` matching `filters` with COUNT(*) or, for mode
+'estimate' on an unfiltered table, with the planner statistics kept in
+pg_class.
+'''
+def count_rows(session, table, mode='exact', filters=()):
+    if (mode == 'estimate' and not filters and
+            session.get_bind().dialect.name == 'postgresql'):
+        estimate = session.execute(
+            text("SELECT reltuples::bigint FROM pg_class "
+                 "WHERE oid = CAST(:table AS regclass)"),
+            {'table': table.name}
+        ).scalar()
+        if estimate is not None and estimate >= settings.COUNT_ESTIMATE_THRESHOLD:
+            return estimate
+
+    return session.execute(
+        select(func.count()).select_from(table).where(*filters)
+    ).scalar()
@@ -0,0 +1,205 @@
+import math
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from config import settings
+from metrics import RATE_LIMITED
+
+
+'''
+Rate limit
+
+Admission control for the authenticated routes. Every token subject (`sub`)
+has a token bucket per permission, holding up to `burst` requests and
+refilled at `rate` requests per second. Each request takes a token; one that
+finds its bucket empty is rejected with 429 and Retry-After by
+requires_auth, right after the token is verified and before the view runs,
+so it never reaches the database.
+
+The limits are RATE_LIMIT_RATE and RATE_LIMIT_BURST, overridden per
+permission by RATE_LIMITS, e.g. "get:performance=2/5". A rate of 0 lifts
+the limit for that permission.
+
+Buckets live in a store: MemoryStore keeps them per process, so under
+gunicorn every worker admits the full rate; RedisStore shares them between
+workers. A store that is down lets requests through.
+'''
+
+Limit = namedtuple('Limit', 'rate burst')
+
+
+'''
+parse_limits(value)
+Reads "permission=rate/burst,..." into Limits by permission. The burst
+defaults to the rate, rounded up. A malformed entry raises ValueError
+naming it, so a bad RATE_LIMITS stops the app at startup with a clear
+message.
+'''
+def parse_limits(value):
+    limits = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        permission, _, limit = item.partition('=')
+        rate, _, burst = limit.partition('/')
+        try:
+            if not permission.strip():
+                raise ValueError
+            rate = float(rate)
+            if not math.isfinite(rate):
+                raise ValueError
+            burst = int(burst) if burst.strip() else max(1, math.ceil(rate))
+            if rate < 0 or burst < 1:
+                raise ValueError
+        except ValueError:
+            raise ValueError(
+                'Invalid RATE_LIMITS entry %r, expected permission=rate or '
+                'permission=rate/burst with rate >= 0 and burst >= 1.' % item.strip())
+        limits[permission.strip()] = Limit(rate, burst)
+    return limits
+
+
+'''
+MemoryStore
+Buckets of this process, least recently used ones dropped beyond
+`max_keys`. A dropped bucket starts full again.
+'''
+class MemoryStore:
+
+    blocking = False
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    take(key, rate, burst)
+    Takes a token from the bucket of `key`. Returns 0 when there was one, and
+    otherwise the seconds until there is.
+    '''
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+'''
+RedisStore
+Shares the buckets between workers through any client speaking the
+redis-py API. Each take is one script call, atomic on the server and timed
+by the server clock. A bucket expires once it would have refilled.
+'''
+class RedisStore:
+
+    blocking = True
+
+    TAKE = '''
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+    def __init__(self, client, prefix='casting:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(self.TAKE)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[self.prefix + key], args=[rate, burst]))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class RateLimiter:
+
+    def __init__(self, store=None):
+        self.store = store
+        self.default = None
+        self.limits = {}
+
+    '''
+    init_app(app)
+    Reads the limits and sets up the configured store, unless one was passed
+    in.
+    '''
+    def init_app(self, app):
+        if self.store is None:
+            self.store = make_store()
+        self.default = Limit(settings.RATE_LIMIT_RATE, settings.RATE_LIMIT_BURST)
+        self.limits = parse_limits(settings.RATE_LIMITS)
+
+    @property
+    def blocking(self):
+        return getattr(self.store, 'blocking', False)
+
+    '''
+    check(payload, permission)
+    Takes a token for the caller of a verified `payload` on `permission`.
+    Returns 0 when the request is admitted, and otherwise the whole seconds
+    to send in Retry-After.
+    '''
+    def check(self, payload, permission):
+        if self.store is None:
+            return 0
+        limit = self.limits.get(permission, self.default)
+        if limit is None or limit.rate <= 0:
+            return 0
+        try:
+            wait = self.store.take(
+                '%s|%s' % (payload.get('sub'), permission), limit.rate, limit.burst)
+        except Exception:
+            print(sys.exc_info())
+            return 0
+        if not wait:
+            return 0
+        RATE_LIMITED.labels(permission).inc()
+        return max(1, math.ceil(wait))
+
+
+def make_store():
+    if settings.RATE_LIMIT_BACKEND == 'redis':
+        return RedisStore.from_url(settings.RATE_LIMIT_REDIS_URL)
+    if settings.RATE_LIMIT_BACKEND == 'memory':
+        return MemoryStore(max_keys=settings.RATE_LIMIT_MAX_KEYS)
+    return None
+
+
+rate_limiter = RateLimiter()
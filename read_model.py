@@ -0,0 +1,206 @@
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, select, text, tuple_
+
+from config import settings
+from models import (db, Movie, Actor, Performance, CastingDetail, bump_versions,
+                    lift_statement_timeout)
+
+
+'''
+Casting read model
+
+With CASTING_READ_MODEL on, the castings that /performances and the cast
+lists of /movies and /actors return are read from casting_details, one row
+per casting with its movie and actor columns already joined, instead of
+joining three tables on every request.
+
+The write routes keep it in step, in the same transaction as their change:
+  - new castings are copied in by record_castings(),
+  - a movie or actor PATCH rewrites its columns through refresh_movie() or
+    refresh_actor(),
+  - deletes cascade from performance.
+
+Streamed listings keep loading casts through the relationships.
+
+`flask read-model check` compares the table with the normalized ones and
+`flask read-model rebuild` replaces its contents. Turn the setting on only
+after a rebuild, since the table is not kept while it is off.
+'''
+
+CAST_COLUMNS = ('actor_id', 'actor_name', 'actor_age', 'actor_gender')
+CASTING_COLUMNS = ('movie_id', 'movie_title', 'movie_release_date')
+
+
+def enabled():
+    return settings.CASTING_READ_MODEL
+
+
+'''
+joined_castings()
+The read model rows as the normalized tables have them.
+'''
+def joined_castings():
+    return select(
+        Performance.c.id,
+        Performance.c.movie_id,
+        Movie.title,
+        Movie.release_date,
+        Performance.c.actor_id,
+        Actor.name,
+        Actor.age,
+        Actor.gender
+    ).select_from(
+        Performance.join(Movie, Movie.id == Performance.c.movie_id)
+                   .join(Actor, Actor.id == Performance.c.actor_id))
+
+
+'''
+record_castings(pairs)
+Copies the castings just created for (actor_id, movie_id) `pairs`. Their
+movie and actor rows are read FOR SHARE, so a concurrent PATCH either
+finishes first and is copied, or waits and rewrites these rows too.
+`session` defaults to db.session.
+'''
+def record_castings(pairs, session=None):
+    if not enabled() or not pairs:
+        return
+    session = session or db.session
+    pairs = list(pairs)
+    size = settings.BULK_BATCH_SIZE
+    for start in range(0, len(pairs), size):
+        rows = joined_castings().where(
+            tuple_(Performance.c.actor_id, Performance.c.movie_id).in_(
+                pairs[start:start + size])
+        ).with_for_update(read=True, of=(Movie.__table__, Actor.__table__))
+        session.execute(CastingDetail.insert().from_select(
+            [column.name for column in CastingDetail.c], rows))
+
+
+'''
+refresh_movie(movie_id) / refresh_actor(actor_id)
+Rewrites the copied columns of one movie or actor after a PATCH, once the
+change is flushed.
+'''
+def refresh_movie(movie_id, session=None):
+    if not enabled():
+        return
+    session = session or db.session
+    session.flush()
+    session.execute(
+        CastingDetail.update()
+        .where(CastingDetail.c.movie_id == Movie.__table__.c.id)
+        .where(Movie.__table__.c.id == movie_id)
+        .values(movie_title=Movie.__table__.c.title,
+                movie_release_date=Movie.__table__.c.release_date))
+
+
+def refresh_actor(actor_id, session=None):
+    if not enabled():
+        return
+    session = session or db.session
+    session.flush()
+    session.execute(
+        CastingDetail.update()
+        .where(CastingDetail.c.actor_id == Actor.__table__.c.id)
+        .where(Actor.__table__.c.id == actor_id)
+        .values(actor_name=Actor.__table__.c.name,
+                actor_age=Actor.__table__.c.age,
+                actor_gender=Actor.__table__.c.gender))
+
+
+def related_rows(key, columns, ids, session=None):
+    session = session or db.session
+    rows = session.execute(
+        select(CastingDetail.c[key], *[CastingDetail.c[name] for name in columns])
+        .where(CastingDetail.c[key].in_(ids))
+        .order_by(CastingDetail.c.id))
+    related = {}
+    for row in rows:
+        related.setdefault(row[0], []).append(dict(zip(columns, row[1:])))
+    return related
+
+
+'''
+movie_casts(movie_ids) / actor_castings(actor_ids)
+The listing shaped casts of `movie_ids` or castings of `actor_ids`, keyed by
+id, in one query.
+'''
+def movie_casts(movie_ids, session=None):
+    return related_rows('movie_id', CAST_COLUMNS, movie_ids, session)
+
+
+def actor_castings(actor_ids, session=None):
+    return related_rows('actor_id', CASTING_COLUMNS, actor_ids, session)
+
+
+'''
+performances_query(session)
+The /performances rows from the read model, labelled like the join they
+replace.
+'''
+def performances_query(session):
+    return session.query(
+        CastingDetail.c.id,
+        CastingDetail.c.movie_id,
+        CastingDetail.c.movie_title.label('title'),
+        CastingDetail.c.movie_release_date.label('release_date'),
+        CastingDetail.c.actor_id,
+        CastingDetail.c.actor_name.label('name'),
+        CastingDetail.c.actor_age.label('age'),
+        CastingDetail.c.actor_gender.label('gender')
+    )
+
+
+'''
+check(session)
+Returns (missing, unexpected): the joined rows the read model lacks or has
+stale, and its rows that no longer match a casting.
+'''
+def check(session):
+    expected = joined_castings()
+    actual = select(*CastingDetail.c)
+    missing = session.execute(
+        select(func.count()).select_from(expected.except_(actual).subquery())).scalar()
+    unexpected = session.execute(
+        select(func.count()).select_from(actual.except_(expected).subquery())).scalar()
+    return missing, unexpected
+
+
+'''
+rebuild(session)
+Replaces the read model with the joined rows, with writes to castings held
+off until the caller commits. Returns the number of rows.
+'''
+def rebuild(session):
+    session.execute(text('LOCK TABLE performance IN SHARE MODE'))
+    session.execute(text('LOCK TABLE casting_details IN EXCLUSIVE MODE'))
+    session.execute(CastingDetail.delete())
+    result = session.execute(CastingDetail.insert().from_select(
+        [column.name for column in CastingDetail.c], joined_castings()))
+    bump_versions('performance', session=session)
+    return result.rowcount
+
+
+read_model_cli = AppGroup('read-model', help='Casting read model.')
+
+
+@read_model_cli.command('check')
+def check_command():
+    '''Compare casting_details with the normalized tables.'''
+    lift_statement_timeout(db.engine)
+    missing, unexpected = check(db.session)
+    click.echo('%d missing or stale rows, %d unexpected rows.' % (missing, unexpected))
+    if missing or unexpected:
+        raise SystemExit(1)
+
+
+@read_model_cli.command('rebuild')
+def rebuild_command():
+    '''Check casting_details, then rebuild it from the normalized tables.'''
+    lift_statement_timeout(db.engine)
+    missing, unexpected = check(db.session)
+    click.echo('%d missing or stale rows, %d unexpected rows.' % (missing, unexpected))
+    rows = rebuild(db.session)
+    db.session.commit()
+    click.echo('Rebuilt casting_details with %d rows.' % rows)
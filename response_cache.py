@@ -0,0 +1,283 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+from flask import Response, g, make_response, request
+from functools import wraps
+
+from config import settings
+from single_flight import make_single_flight
+
+
+'''
+Response cache
+
+Serialized bodies of successful GET responses, keyed by route, path, query
+args, the caller's permission set and the change versions that
+@conditional stored for the request. Each entry also carries tags naming
+what it was built from, and the write routes invalidate exactly the tags
+they touch.
+
+Because the change versions are part of the key, an entry written before a
+change can never be served after it, even by a worker whose own copy was not
+invalidated.
+
+Misses go through single_flight, when it is on, so concurrent identical
+misses render the response once.
+
+Tags used by the routes:
+  movies     - movie rows in the /movies listing
+  actors     - actor rows in the /actors listing
+  castings   - anything that renders joined movie/actor data
+  movie:<id> - GET /movies/<id>
+  actor:<id> - GET /actors/<id>
+'''
+
+
+'''
+MemoryBackend
+In-process LRU, capped at `max_bytes` of keys plus bodies.
+'''
+class MemoryBackend:
+
+    blocking = False
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, tags):
+        cost = len(key) + len(value)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, tags)
+            self.size += cost
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        value, tags = entry
+        self.size -= len(key) + len(value)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+'''
+RedisBackend
+Shares the cache between workers through any client speaking the redis-py
+API, a real server or a local stand-in. Eviction is left to the server's
+maxmemory policy (use allkeys-lru) and every entry also expires after `ttl`
+seconds. Tags are kept as sets of keys.
+'''
+class RedisBackend:
+
+    blocking = True
+
+    def __init__(self, client, prefix='casting:cache:', ttl=300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, tags):
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, value, ex=self.ttl)
+        for tag in tags:
+            pipe.sadd(self.prefix + 'tag:' + tag, key)
+            pipe.expire(self.prefix + 'tag:' + tag, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, tags):
+        tag_keys = [self.prefix + 'tag:' + tag for tag in tags]
+        pipe = self.client.pipeline()
+        for tag_key in tag_keys:
+            pipe.smembers(tag_key)
+        members = pipe.execute()
+
+        keys = set(tag_keys)
+        for group in members:
+            keys.update(self.prefix + self._text(key) for key in group)
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    @staticmethod
+    def _text(key):
+        return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+class ResponseCache:
+
+    def __init__(self, backend=None, flights=None, release=None):
+        self.backend = backend
+        self.flights = flights
+        self.release = release
+        self.hits = 0
+        self.misses = 0
+
+    '''
+    init_app(app, release)
+    Sets up the configured backend and request coalescing when the app is
+    created, unless they were passed in. `release` hands back what a
+    request holds before it waits for an identical one, e.g. its database
+    session.
+    '''
+    def init_app(self, app, release=None):
+        if self.backend is None:
+            self.backend = make_backend()
+        if self.flights is None:
+            self.flights = make_single_flight(self.backend)
+        if release is not None:
+            self.release = release
+
+    '''
+    cached(*tags)
+    Decorator for read views that sit below requires_auth and @conditional.
+    Tags may reference view arguments, e.g. 'movie:{movie_id}'.
+    '''
+    def cached(self, *tags):
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(payload, *args, **kwargs):
+                if self.backend is None and self.flights is None:
+                    return f(payload, *args, **kwargs)
+
+                key = self.make_key(payload)
+                if self.backend is not None:
+                    body = self.lookup(key)
+                    if body is not None:
+                        self.hits += 1
+                        return self.body_response(body)
+                    self.misses += 1
+
+                def render():
+                    response = make_response(f(payload, *args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response, None
+                    body = response.get_data()
+                    self.store(key, body, [tag.format(**kwargs) for tag in tags])
+                    return response, body
+
+                if self.flights is None:
+                    return render()[0]
+                response, body = self.flights.run(key, render, self.lookup, self.release)
+                return response if response is not None else self.body_response(body)
+
+            return wrapper
+        return cached_decorator
+
+    def lookup(self, key):
+        if self.backend is None:
+            return None
+        return self._call(self.backend.get, key)
+
+    def store(self, key, body, tags):
+        if self.backend is not None:
+            self._call(self.backend.set, key, body, tags)
+
+    @property
+    def blocking(self):
+        return getattr(self.backend, 'blocking', False)
+
+    @staticmethod
+    def body_response(body):
+        return Response(body, status=200, mimetype='application/json')
+
+    '''
+    make_key(payload, request, versions)
+    The cache key of `request` for the caller of `payload`. `request` and
+    `versions` default to Flask's request and g.change_versions; asgi.py
+    passes its own.
+    '''
+    def make_key(self, payload, request=request, versions=None):
+        if versions is None:
+            versions = g.get('change_versions', ())
+        parts = [request.endpoint, request.path]
+        parts.extend('%s=%s' % item for item in sorted(request.args.items(multi=True)))
+        parts.extend(sorted(payload.get('permissions', [])))
+        parts.extend(str(version) for version in versions)
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    '''
+    invalidate(*tags)
+    Drops every entry carrying one of `tags`. Called by the write routes
+    after their commit.
+    '''
+    def invalidate(self, *tags):
+        if self.backend is not None:
+            self._call(self.backend.invalidate, tags)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    # A cache that is down must not take the API with it, so backend errors
+    # are logged and treated as misses.
+    @staticmethod
+    def _call(method, *args):
+        try:
+            return method(*args)
+        except Exception:
+            print(sys.exc_info())
+            return None
+
+
+def make_backend():
+    if settings.RESPONSE_CACHE_BACKEND == 'redis':
+        return RedisBackend.from_url(
+            settings.RESPONSE_CACHE_REDIS_URL, ttl=settings.RESPONSE_CACHE_TTL)
+    if settings.RESPONSE_CACHE_BACKEND == 'memory':
+        return MemoryBackend(max_bytes=settings.RESPONSE_CACHE_MAX_BYTES)
+    return None
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,260 @@
+import io
+import random
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from bulk import reserve_ids
+from models import db, VERSIONED_TABLES, bump_versions, lift_statement_timeout
+import read_model
+
+
+'''
+Synthetic data
+
+`flask seed` fills the database with generated movies, actors and castings
+for capacity testing. Everything is derived from --seed, so the same
+arguments always produce the same rows.
+
+Castings follow a power law on both sides: cast sizes are drawn from a
+Pareto distribution, so most movies have a handful of actors and a few have
+hundreds, and actors are picked with Zipf weights, so a few actors appear
+in a large share of the movies. Popularity is assigned in a shuffled order,
+not by id.
+
+Rows are written with COPY, --batch-size rows per transaction. Into an
+empty performance table, the foreign keys, the unique constraint and the
+secondary indexes are dropped for the load and recreated afterwards, which
+checks them once over the whole table instead of once per row.
+'''
+
+ADJECTIVES = (
+    'Silent', 'Crimson', 'Broken', 'Golden', 'Last', 'Hidden', 'Wild',
+    'Midnight', 'Frozen', 'Electric', 'Lost', 'Burning', 'Distant', 'Iron',
+    'Velvet', 'Hollow', 'Rainy', 'Savage', 'Gentle', 'Northern'
+)
+NOUNS = (
+    'River', 'Temple', 'Empire', 'Garden', 'Highway', 'Mirror', 'Harbor',
+    'Kingdom', 'Signal', 'Orchard', 'Frontier', 'Station', 'Winter', 'Canyon',
+    'Promise', 'Shadow', 'Island', 'Circus', 'Voyage', 'Horizon'
+)
+FIRST_NAMES = (
+    'Arturo', 'Viki', 'Goran', 'Maria', 'James', 'Aiko', 'Lena', 'Omar',
+    'Sofia', 'Daniel', 'Priya', 'Lucas', 'Elena', 'Kwame', 'Hana', 'Mateo',
+    'Ingrid', 'Ravi', 'Chloe', 'Tomas'
+)
+LAST_NAMES = (
+    'Valdes', 'Jones', 'Snipe', 'Novak', 'Okafor', 'Tanaka', 'Larsen',
+    'Haddad', 'Rossi', 'Kim', 'Mendez', 'Fischer', 'Ivanova', 'Mensah',
+    'Dubois', 'Sato', 'Costa', 'Nair', 'Walsh', 'Berg'
+)
+GENDERS = ('Female', 'Male')
+FIRST_RELEASE = datetime(1920, 1, 1)
+RELEASE_SPAN_HOURS = 105 * 365 * 24
+
+
+def zipf_cum_weights(n, exponent):
+    return list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(n)))
+
+
+'''
+cast_sizes(rng, movies, castings, max_cast, shape)
+Pareto distributed cast sizes, capped at max_cast and adding up to exactly
+`castings`.
+'''
+def cast_sizes(rng, movies, castings, max_cast, shape):
+    raw = [rng.paretovariate(shape) for _ in range(movies)]
+    scale = castings / sum(raw)
+    sizes = [min(max_cast, int(value * scale)) for value in raw]
+
+    # Hand out what rounding and the cap left over, largest casts first
+    missing = castings - sum(sizes)
+    order = sorted(range(movies), key=raw.__getitem__, reverse=True)
+    while missing > 0:
+        for index in order:
+            if sizes[index] < max_cast:
+                sizes[index] += 1
+                missing -= 1
+                if missing == 0:
+                    break
+    return sizes
+
+
+'''
+copy_rows(conn, table, columns, rows)
+COPY in text format. Generated values never contain tabs, newlines or
+backslashes, so they are written unescaped.
+'''
+def copy_rows(conn, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(map(str, row)))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+'''
+without_constraints(engine, table)
+Drops the foreign key and unique constraints and the indexes of `table`
+other than its primary key, and recreates them from their catalog
+definitions on exit, even when the load failed.
+'''
+@contextmanager
+def without_constraints(engine, table):
+    with engine.begin() as conn:
+        constraints = conn.execute(text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = CAST(:table AS regclass) AND contype IN ('f', 'u')"),
+            {'table': table}).all()
+        indexes = conn.execute(text(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE tablename = :table AND indexname NOT IN ("
+            "  SELECT conname FROM pg_constraint "
+            "  WHERE conrelid = CAST(:table AS regclass))"),
+            {'table': table}).all()
+        for name, _ in constraints:
+            conn.execute(text('ALTER TABLE %s DROP CONSTRAINT %s' % (table, name)))
+        for name, _ in indexes:
+            conn.execute(text('DROP INDEX %s' % name))
+    try:
+        yield
+    finally:
+        with engine.begin() as conn:
+            for _, definition in indexes:
+                conn.execute(text(definition))
+            for name, definition in constraints:
+                conn.execute(text(
+                    'ALTER TABLE %s ADD CONSTRAINT %s %s' % (table, name, definition)))
+
+
+def is_empty(engine, table):
+    with engine.connect() as conn:
+        return conn.execute(text('SELECT NOT EXISTS (SELECT 1 FROM %s)' % table)).scalar()
+
+
+def movie_rows(rng, ids):
+    for movie_id in ids:
+        title = '%s %s %d' % (rng.choice(ADJECTIVES), rng.choice(NOUNS), movie_id)
+        release_date = FIRST_RELEASE + timedelta(hours=rng.randrange(RELEASE_SPAN_HOURS))
+        yield movie_id, title, release_date.isoformat(' ')
+
+
+def actor_rows(rng, ids):
+    for actor_id in ids:
+        name = '%s %s %d' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), actor_id)
+        yield actor_id, name, rng.randint(18, 90), rng.choice(GENDERS)
+
+
+def casting_rows(rng, movie_ids, actor_ids, sizes, exponent):
+    by_popularity = actor_ids[:]
+    rng.shuffle(by_popularity)
+    cum_weights = zipf_cum_weights(len(by_popularity), exponent)
+
+    for movie_id, size in zip(movie_ids, sizes):
+        if size * 2 > len(by_popularity):
+            cast = rng.sample(by_popularity, size)
+        else:
+            cast = set()
+            while len(cast) < size:
+                cast.update(rng.choices(
+                    by_popularity, cum_weights=cum_weights, k=size - len(cast)))
+        for actor_id in cast:
+            yield actor_id, movie_id
+
+
+def write_batches(engine, table, columns, rows, total, batch_size, label):
+    batch = []
+    with click.progressbar(length=total, label=label) as bar:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                with engine.begin() as conn:
+                    copy_rows(conn, table, columns, batch)
+                bar.update(len(batch))
+                batch = []
+        if batch:
+            with engine.begin() as conn:
+                copy_rows(conn, table, columns, batch)
+            bar.update(len(batch))
+
+
+'''
+seed_database(engine, movies, actors, castings, ...)
+Generates and writes the rows, rebuilds the casting read model when it is
+on, then bumps the change versions so cached listings are invalidated. Returns the new movie and actor ids.
+'''
+def seed_database(engine, movies, actors, castings, seed=0, batch_size=50000,
+                  max_cast=200, exponent=0.8, shape=1.5):
+    max_cast = min(max_cast, actors)
+    if castings > movies * max_cast:
+        raise ValueError('At most %d castings fit %d movies with casts of up to %d actors.'
+                         % (movies * max_cast, movies, max_cast))
+    rng = random.Random(seed)
+
+    with engine.begin() as conn:
+        movie_ids = reserve_ids(conn, 'movies', movies)
+        actor_ids = reserve_ids(conn, 'actors', actors)
+
+    write_batches(engine, 'movies', ('id', 'title', 'release_date'),
+                  movie_rows(rng, movie_ids), movies, batch_size, 'movies')
+    write_batches(engine, 'actors', ('id', 'name', 'age', 'gender'),
+                  actor_rows(rng, actor_ids), actors, batch_size, 'actors')
+    if movies and actors and castings:
+        sizes = cast_sizes(rng, movies, castings, max_cast, shape)
+        rows = casting_rows(rng, movie_ids, actor_ids, sizes, exponent)
+        if is_empty(engine, 'performance'):
+            with without_constraints(engine, 'performance'):
+                write_batches(engine, 'performance', ('actor_id', 'movie_id'),
+                              rows, castings, batch_size, 'castings')
+        else:
+            write_batches(engine, 'performance', ('actor_id', 'movie_id'),
+                          rows, castings, batch_size, 'castings')
+
+    with engine.begin() as conn:
+        if read_model.enabled():
+            read_model.rebuild(conn)
+        bump_versions(*VERSIONED_TABLES, session=conn)
+    with engine.connect() as conn:
+        for table in VERSIONED_TABLES + ('casting_details',):
+            conn.execute(text('ANALYZE %s' % table))
+    return movie_ids, actor_ids
+
+
+@click.command('seed')
+@click.option('--movies', default=10000, show_default=True)
+@click.option('--actors', default=10000, show_default=True)
+@click.option('--castings', default=100000, show_default=True)
+@click.option('--seed', 'seed_value', default=0, show_default=True,
+              help='Random seed, the same seed generates the same rows.')
+@click.option('--batch-size', default=50000, show_default=True,
+              help='Rows per COPY and transaction.')
+@click.option('--max-cast', default=200, show_default=True,
+              help='Largest number of actors in one movie.')
+@click.option('--exponent', default=0.8, show_default=True,
+              help='Zipf exponent of actor popularity.')
+@click.option('--reset', is_flag=True,
+              help='Drop and recreate all tables first.')
+@with_appcontext
+def seed_command(movies, actors, castings, seed_value, batch_size, max_cast,
+                 exponent, reset):
+    '''Generate synthetic movies, actors and castings.'''
+    lift_statement_timeout(db.engine)
+    if reset:
+        db.drop_all()
+        db.create_all()
+    try:
+        seed_database(db.engine, movies, actors, castings, seed=seed_value,
+                      batch_size=batch_size, max_cast=max_cast, exponent=exponent)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    click.echo('Seeded %d movies, %d actors and %d castings.' % (movies, actors, castings))
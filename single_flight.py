@@ -0,0 +1,191 @@
+import sys
+import threading
+import time
+import uuid
+
+from config import settings
+from metrics import SINGLE_FLIGHT_SHARED
+
+
+'''
+Single flight
+
+Concurrent identical requests to a cached read route share one rendering.
+On a response cache miss, ResponseCache.cached() hands the cache key to
+SingleFlight.run(): the first request for the key leads and renders the
+response, and requests for the same key that arrive meanwhile wait for it
+and answer with its body. The key covers the route, path, query args,
+permission set and change versions, so only requests that would have got
+the same answer are coalesced.
+
+Only successful, non-streamed bodies are shared. The followers of a leader
+that failed, or that is still running after SINGLE_FLIGHT_TIMEOUT seconds,
+render the response themselves. Before waiting they call release(), so
+they do not keep a pooled connection idle in a transaction meanwhile.
+
+Within a process, requests only overlap on threaded workers (gunicorn
+--threads). The sync single threaded workers of the Procfile never
+coalesce, which is why SINGLE_FLIGHT defaults to none.
+
+With a RedisLock (SINGLE_FLIGHT=redis and the redis response cache), every
+process leader also takes a lock in Redis. The leaders of other workers
+that find the key locked wait for the body to show up in the response
+cache instead of rendering it again.
+'''
+
+
+class Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+
+
+'''
+RedisLock
+Per key locks in Redis, expiring after `ttl` seconds in case their holder
+dies. Released only by their holder.
+'''
+class RedisLock:
+
+    RELEASE = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+    def __init__(self, client, prefix='casting:flight:', poll_interval=0.02):
+        self.client = client
+        self.prefix = prefix
+        self.poll_interval = poll_interval
+        self._release = client.register_script(self.RELEASE)
+
+    '''
+    acquire(key, ttl)
+    Returns a token to release the lock with, or None when it is held.
+    '''
+    def acquire(self, key, ttl):
+        token = uuid.uuid4().hex
+        if self.client.set(self.prefix + key, token, nx=True, px=int(ttl * 1000)):
+            return token
+        return None
+
+    def release(self, key, token):
+        self._release(keys=[self.prefix + key], args=[token])
+
+    '''
+    wait(key, lookup, timeout)
+    Polls lookup(key) until it returns a body, the lock is released or
+    `timeout` seconds have passed. Returns the body or None.
+    '''
+    def wait(self, key, lookup, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            body = lookup(key)
+            if body is not None:
+                return body
+            if not self.client.exists(self.prefix + key):
+                return lookup(key)
+            time.sleep(self.poll_interval)
+        return None
+
+
+class SingleFlight:
+
+    def __init__(self, timeout=10, lock=None):
+        self.timeout = timeout
+        self.lock = lock
+        self._flights = {}
+        self._mutex = threading.Lock()
+
+    '''
+    run(key, render, lookup, release)
+    Returns (response, body) for `key`. render() returns them for a request
+    that renders itself, with body None when it is not shareable. A shared
+    body comes back with response None. lookup(key) reads the response
+    cache, where a leader that just finished may have left the body.
+    release(), when given, is called before the request waits for another.
+    '''
+    def run(self, key, render, lookup, release=None):
+        flight, leader = self._join(key)
+        if not leader:
+            if release is not None:
+                release()
+            flight.done.wait(self.timeout)
+            if flight.body is not None:
+                SINGLE_FLIGHT_SHARED.labels('process').inc()
+                return None, flight.body
+            return render()
+
+        body = None
+        try:
+            response, body = self._lead(key, render, lookup, release)
+            return response, body
+        finally:
+            self._finish(key, flight, body)
+
+    def _lead(self, key, render, lookup, release=None):
+        body = lookup(key)
+        if body is not None:
+            return None, body
+        if self.lock is None:
+            return render()
+
+        # A lock that cannot be reached must not hold the request up
+        try:
+            token = self.lock.acquire(key, self.timeout)
+        except Exception:
+            print(sys.exc_info())
+            return render()
+
+        if token is None:
+            if release is not None:
+                release()
+            try:
+                body = self.lock.wait(key, lookup, self.timeout)
+            except Exception:
+                print(sys.exc_info())
+            if body is not None:
+                SINGLE_FLIGHT_SHARED.labels('redis').inc()
+                return None, body
+            return render()
+
+        try:
+            return render()
+        finally:
+            try:
+                self.lock.release(key, token)
+            except Exception:
+                print(sys.exc_info())
+
+    def _join(self, key):
+        with self._mutex:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def _finish(self, key, flight, body):
+        flight.body = body
+        with self._mutex:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.done.set()
+
+
+'''
+make_single_flight(backend)
+The coalescing layer for a response cache with `backend`. Across workers it
+needs the redis backend, whose client also holds the locks; with any other
+backend SINGLE_FLIGHT=redis coalesces within the process only.
+'''
+def make_single_flight(backend):
+    if settings.SINGLE_FLIGHT not in ('memory', 'redis'):
+        return None
+    lock = None
+    client = getattr(backend, 'client', None)
+    if settings.SINGLE_FLIGHT == 'redis' and client is not None:
+        lock = RedisLock(client)
+    return SingleFlight(timeout=settings.SINGLE_FLIGHT_TIMEOUT, lock=lock)
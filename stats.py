@@ -0,0 +1,131 @@
+from sqlalchemy import Integer, and_, cast, extract, func, select, tuple_
+
+from models import db, Movie, Actor, Performance
+
+
+'''
+Casting statistics
+
+  /movies/stats?released_after=&released_before=&title=
+  /actors/stats?released_after=&released_before=&name=&gender=&age_min=&age_max=
+
+Each report is one query: a CTE counting the castings of every matching
+movie or actor, aggregated over GROUPING SETS so the totals and every
+breakdown come back together. GROUPING() tells the rows of each set apart.
+
+On /actors/stats the release date range selects which castings are
+counted, actors without castings in it are still counted with 0.
+'''
+
+
+def summary(row):
+    return {
+        'min': row.min,
+        'max': row.max,
+        'mean': round(float(row.mean), 2) if row.mean is not None else None
+    }
+
+
+'''
+movie_stats(filters)
+Movies and castings in total, the cast size distribution and the movies
+per release year. `filters` are movie_filters() predicates.
+'''
+def movie_stats(filters, session=None):
+    session = session or db.session
+    per_movie = select(
+        Movie.id,
+        cast(extract('year', Movie.release_date), Integer).label('year'),
+        func.count(Performance.c.id).label('cast_size')
+    ).select_from(
+        Movie.__table__.outerjoin(Performance, Performance.c.movie_id == Movie.id)
+    ).where(*filters).group_by(Movie.id).cte('per_movie')
+
+    year, size = per_movie.c.year, per_movie.c.cast_size
+    rows = session.execute(select(
+        func.grouping(year, size).label('grouping'),
+        year,
+        size,
+        func.count().label('movies'),
+        func.coalesce(func.sum(size), 0).label('castings'),
+        func.min(size).label('min'),
+        func.max(size).label('max'),
+        func.avg(size).label('mean')
+    ).group_by(func.grouping_sets(tuple_(), tuple_(year), tuple_(size))))
+
+    stats = {'cast_size': {'histogram': []}, 'by_year': []}
+    for row in rows:
+        if row.grouping == 3:
+            stats['movies'] = row.movies
+            stats['castings'] = int(row.castings)
+            stats['cast_size'].update(summary(row))
+        elif row.grouping == 1:
+            stats['by_year'].append(
+                {'year': row.year, 'movies': row.movies, 'castings': int(row.castings)})
+        else:
+            stats['cast_size']['histogram'].append(
+                {'cast_size': row.cast_size, 'movies': row.movies})
+    stats['by_year'].sort(key=lambda item: item['year'])
+    stats['cast_size']['histogram'].sort(key=lambda item: item['cast_size'])
+    return stats
+
+
+'''
+actor_stats(filters, castings_filters)
+Actors and castings in total, the distribution of castings per actor and
+the breakdowns by gender and by age decade. `filters` are actor_filters()
+predicates, `castings_filters` release_filters() predicates on the movies
+whose castings count.
+'''
+def actor_stats(filters, castings_filters=(), session=None):
+    session = session or db.session
+    castings = Performance
+    if castings_filters:
+        castings = Performance.join(
+            Movie, and_(Movie.id == Performance.c.movie_id, *castings_filters))
+    per_actor = select(
+        Actor.id,
+        Actor.gender,
+        (Actor.age - Actor.age % 10).label('decade'),
+        func.count(Performance.c.id).label('castings')
+    ).select_from(
+        Actor.__table__.outerjoin(castings, Performance.c.actor_id == Actor.id)
+    ).where(*filters).group_by(Actor.id).cte('per_actor')
+
+    gender, decade, count = per_actor.c.gender, per_actor.c.decade, per_actor.c.castings
+    rows = session.execute(select(
+        func.grouping(gender, decade, count).label('grouping'),
+        gender,
+        decade,
+        count,
+        func.count().label('actors'),
+        func.coalesce(func.sum(count), 0).label('total'),
+        func.min(count).label('min'),
+        func.max(count).label('max'),
+        func.avg(count).label('mean')
+    ).group_by(func.grouping_sets(
+        tuple_(), tuple_(gender), tuple_(decade), tuple_(count))))
+
+    stats = {'castings_per_actor': {'histogram': []}, 'by_gender': [], 'by_age': []}
+    for row in rows:
+        if row.grouping == 7:
+            stats['actors'] = row.actors
+            stats['castings'] = int(row.total)
+            stats['castings_per_actor'].update(summary(row))
+        elif row.grouping == 3:
+            stats['by_gender'].append(
+                {'gender': row.gender, 'actors': row.actors, 'castings': int(row.total)})
+        elif row.grouping == 5:
+            stats['by_age'].append({
+                'age_from': row.decade,
+                'age_to': row.decade + 9,
+                'actors': row.actors,
+                'castings': int(row.total)
+            })
+        else:
+            stats['castings_per_actor']['histogram'].append(
+                {'castings': row.castings, 'actors': row.actors})
+    stats['by_gender'].sort(key=lambda item: item['gender'])
+    stats['by_age'].sort(key=lambda item: item['age_from'])
+    stats['castings_per_actor']['histogram'].sort(key=lambda item: item['castings'])
+    return stats
@@ -0,0 +1,39 @@
+import json
+from flask import Response, current_app, stream_with_context
+
+from config import settings
+
+
+'''
+Streaming JSON listings
+
+stream_listing() answers a full-collection request without ever holding the
+whole collection in memory. Rows are read in chunks of STREAM_CHUNK_SIZE
+through a server-side cursor (`yield_per`) and each one is written out as
+soon as it is formatted, so worker memory stays flat however large the
+table gets.
+
+The body has the same shape as the non-streamed listing:
+{"success": true, "<details_key>": [...], "<total_key>": n}
+'''
+
+
+def stream_listing(query, details_key, total_key, format_row):
+    rows = iter(query.yield_per(settings.STREAM_CHUNK_SIZE))
+    first = next(rows, None)
+    if first is None:
+        return None
+
+    dumps = current_app.json.dumps
+
+    def generate():
+        total = 1
+        yield '{"success": true, ' + json.dumps(details_key) + ': ['
+        yield dumps(format_row(first))
+        for row in rows:
+            total += 1
+            yield ',' + dumps(format_row(row))
+        yield '], ' + json.dumps(total_key) + ': ' + str(total) + '}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
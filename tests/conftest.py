@@ -0,0 +1,164 @@
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import time
+from collections import namedtuple
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+
+'''
+Test setup
+
+The tests run both apps against the PostgreSQL database in
+TEST_DATABASE_URL, whose tables they drop and recreate, and are skipped
+without it. Tokens are signed with a key generated here and served to the
+apps from a local JWKS file.
+'''
+
+DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+DOMAIN = 'casting.test'
+AUDIENCE = 'casting-test'
+KID = 'test'
+
+KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+PEM = KEY.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                        serialization.NoEncryption())
+
+
+def b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def write_jwks():
+    numbers = KEY.public_key().public_numbers()
+    path = os.path.join(tempfile.mkdtemp(), 'jwks.json')
+    with open(path, 'w') as f:
+        json.dump({'keys': [{'kty': 'RSA', 'kid': KID, 'use': 'sig',
+                             'n': b64(numbers.n), 'e': b64(numbers.e)}]}, f)
+    return path
+
+
+# Settings are read on first use, so this is in time for every app module
+os.environ.update(
+    DATABASE_URL=DATABASE_URL or '',
+    AUTH0_DOMAIN=DOMAIN,
+    API_AUDIENCE=AUDIENCE,
+    ALGORITHMS='RS256',
+    JWKS_FILE=write_jwks(),
+    JWKS_URL='',
+    RESPONSE_CACHE_BACKEND='memory',
+    RATE_LIMIT_BACKEND='none',
+    DATABASE_REPLICA_URL='')
+
+
+def token(*permissions):
+    return jwt.encode({
+        'sub': 'tester',
+        'aud': AUDIENCE,
+        'iss': 'https://%s/' % DOMAIN,
+        'exp': int(time.time()) + 3600,
+        'permissions': list(permissions)
+    }, PEM, algorithm='RS256', headers={'kid': KID})
+
+
+ALL_PERMISSIONS = token(
+    'get:movies', 'post:movies', 'delete:movies',
+    'get:actors', 'post:actors', 'delete:actors',
+    'get:performance', 'post:performance')
+
+
+Result = namedtuple('Result', 'status_code json headers')
+
+
+'''
+Clients
+The same call on either app: request(method, path, json, token, headers)
+returns a Result.
+'''
+class WSGIClient:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json=None, token=ALL_PERMISSIONS, headers=None):
+        headers = dict(headers or {})
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        response = self.client.open(path, method=method, json=json, headers=headers)
+        return Result(response.status_code, response.get_json(silent=True), response.headers)
+
+
+class ASGIClient:
+
+    def __init__(self, app, loop):
+        self.client = app.test_client()
+        self.loop = loop
+
+    def request(self, method, path, json=None, token=ALL_PERMISSIONS, headers=None):
+        headers = dict(headers or {})
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+
+        async def call():
+            response = await self.client.open(path, method=method, json=json, headers=headers)
+            return Result(response.status_code, await response.get_json(silent=True),
+                          response.headers)
+
+        return self.loop.run_until_complete(call())
+
+
+@pytest.fixture(scope='session')
+def wsgi_app():
+    if not DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+@pytest.fixture(scope='session')
+def asgi_app(wsgi_app):
+    pytest.importorskip('quart')
+    import asgi
+
+    loop = asyncio.new_event_loop()
+    yield asgi.create_app(), loop
+    loop.run_until_complete(asgi.get_async_engine().dispose())
+    loop.close()
+
+
+'''
+reset(wsgi_app)
+Empties every table and the response cache.
+'''
+@pytest.fixture
+def reset(wsgi_app):
+    from sqlalchemy import text
+    from models import db
+    from response_cache import response_cache
+
+    with wsgi_app.app_context():
+        tables = ', '.join(table.name for table in db.metadata.sorted_tables)
+        db.session.execute(text('TRUNCATE %s RESTART IDENTITY CASCADE' % tables))
+        db.session.commit()
+    response_cache.backend.clear()
+
+
+@pytest.fixture(params=['wsgi', 'asgi'])
+def client(request, wsgi_app, reset):
+    if request.param == 'wsgi':
+        return WSGIClient(wsgi_app)
+    app, loop = request.getfixturevalue('asgi_app')
+    return ASGIClient(app, loop)
@@ -0,0 +1,166 @@
+from conftest import token
+
+
+'''
+Endpoint tests
+
+Every test runs against app.py and asgi.py alike, through the `client`
+fixture, so the two apps keep answering with the same payloads and status
+codes.
+'''
+
+
+def create_movie(client, title='Up', release_date='2020-01-01'):
+    response = client.request('POST', '/movies', {'title': title, 'release_date': release_date})
+    assert response.status_code == 200
+    return response.json['id']
+
+
+def create_actor(client, name='Ann', age=30, gender='F'):
+    response = client.request('POST', '/actors', {'name': name, 'age': age, 'gender': gender})
+    assert response.status_code == 200
+    return response.json['id']
+
+
+def test_release_date_is_parsed_by_postgresql(client):
+    movie_id = create_movie(client, release_date='January 01 2020')
+
+    response = client.request('PATCH', '/movies/%d' % movie_id,
+                              {'release_date': 'February 02 2021'})
+    assert response.status_code == 200
+    assert response.json['release_date'] == 'February 02 2021'
+
+    response = client.request('GET', '/movies?fields=release_date')
+    assert response.json['movie_details'][0]['movie_release_date'] == 'February 02 2021 00:00:00'
+
+
+def test_invalid_input(client):
+    assert client.request('POST', '/movies', {'title': 'Up'}).status_code == 400
+    assert client.request('POST', '/movies', {'title': 'Up', 'release_date': 'never'}).status_code == 400
+    assert client.request('POST', '/actors', {'name': 'Ann', 'age': 'old', 'gender': 'F'}).status_code == 400
+    assert client.request('POST', '/performance', {'actor_id': 1}).status_code == 400
+    assert client.request('GET', '/movies/abc').status_code == 400
+    assert client.request('GET', '/movies?limit=0').status_code == 400
+
+
+def test_not_found(client):
+    assert client.request('GET', '/movies').status_code == 404
+    assert client.request('GET', '/movies/1').status_code == 404
+    assert client.request('GET', '/actors/1').status_code == 404
+    assert client.request('PATCH', '/movies/1', {'title': 'Up'}).status_code == 404
+    assert client.request('DELETE', '/actors/1').status_code == 404
+
+
+def test_auth(client):
+    response = client.request('GET', '/movies', token=None)
+    assert response.status_code == 401
+    response = client.request('POST', '/movies', {'title': 'Up', 'release_date': '2020-01-01'},
+                              token=token('get:movies'))
+    assert response.status_code == 403
+
+
+def test_castings(client):
+    movie_id = create_movie(client)
+    actor_id = create_actor(client)
+
+    response = client.request('POST', '/performance', {'actor_id': actor_id, 'movie_id': movie_id})
+    assert response.status_code == 200
+    response = client.request('POST', '/performance', {'actor_id': actor_id, 'movie_id': movie_id})
+    assert response.status_code == 400
+
+    response = client.request('GET', '/movies/%d?include=actors' % movie_id)
+    assert response.json['actors'] == [
+        {'actor_id': actor_id, 'actor_name': 'Ann', 'actor_age': 30, 'actor_gender': 'F'}]
+
+    response = client.request('GET', '/performances')
+    assert response.status_code == 200
+    assert [(x['actor_id'], x['movie_id']) for x in response.json['performance_details']] == [
+        (actor_id, movie_id)]
+
+    assert client.request('DELETE', '/movies/%d' % movie_id).status_code == 200
+    assert client.request('GET', '/performances').status_code == 404
+
+
+def test_bulk(client):
+    response = client.request('POST', '/movies/bulk', [
+        {'title': 'Movie %d' % i, 'release_date': '2020-01-01'} for i in range(5)])
+    assert response.status_code == 200
+    ids = response.json['ids']
+    for i, movie_id in enumerate(ids):
+        assert client.request('GET', '/movies/%d' % movie_id).json['movie'] == 'Movie %d' % i
+
+    response = client.request('POST', '/movies/bulk', [{'title': 'Up'}])
+    assert response.status_code == 400
+    assert response.json['errors'][0]['index'] == 0
+
+    actor_id = create_actor(client)
+    response = client.request('POST', '/performance/bulk', [
+        {'actor_id': actor_id, 'movie_id': ids[0]},
+        {'actor_id': actor_id + 1, 'movie_id': ids[0]}])
+    assert response.status_code == 422
+    assert response.json['errors'] == [
+        {'index': 1, 'message': 'actor_id %d does not exist.' % (actor_id + 1)}]
+    assert client.request('GET', '/performances').status_code == 404
+
+
+def test_bulk_release_dates_are_parsed_like_single_ones(client):
+    create_movie(client, release_date='January 01 2020')
+    response = client.request('POST', '/movies/bulk', [
+        {'title': 'Bulk', 'release_date': 'January 01 2020'}])
+    assert response.status_code == 200
+
+    response = client.request('GET', '/movies?fields=release_date')
+    assert [movie['movie_release_date'] for movie in response.json['movie_details']] == [
+        'January 01 2020 00:00:00'] * 2
+
+    assert client.request('POST', '/movies', {'title': 'Up', 'release_date': 'never'}).status_code == 400
+    response = client.request('POST', '/movies/bulk', [
+        {'title': 'Up', 'release_date': 'January 01 2020'},
+        {'title': 'Down', 'release_date': 'never'}])
+    assert response.status_code == 400
+    assert response.json['errors'] == [{'index': 1, 'message': 'release_date is not a valid date.'}]
+
+
+def test_conditional_get(client):
+    create_movie(client)
+
+    response = client.request('GET', '/movies')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = client.request('GET', '/movies', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    create_movie(client, title='Down')
+    response = client.request('GET', '/movies', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(response.json['movie_details']) == 2
+
+
+def test_cached_responses_follow_writes(client):
+    movie_id = create_movie(client)
+    assert client.request('GET', '/movies/%d' % movie_id).json['movie'] == 'Up'
+    assert client.request('GET', '/movies/%d' % movie_id).json['movie'] == 'Up'
+
+    client.request('PATCH', '/movies/%d' % movie_id, {'title': 'Down'})
+    assert client.request('GET', '/movies/%d' % movie_id).json['movie'] == 'Down'
+
+
+def test_apps_answer_alike(wsgi_app, asgi_app, reset):
+    from conftest import WSGIClient, ASGIClient
+
+    wsgi = WSGIClient(wsgi_app)
+    asgi = ASGIClient(*asgi_app)
+    movie_ids = [create_movie(wsgi, title='Movie %d' % i) for i in range(3)]
+    actor_ids = [create_actor(wsgi, name='Actor %d' % i, age=20 + i) for i in range(3)]
+    wsgi.request('POST', '/performance/bulk', [
+        {'actor_id': actor_id, 'movie_id': movie_id}
+        for actor_id in actor_ids for movie_id in movie_ids[:2]])
+
+    for path in ('/movies', '/movies?limit=2&total=exact', '/movies?include=actors&stream=true',
+                 '/movies/stats', '/movies/%d?include=actors' % movie_ids[0],
+                 '/actors', '/actors?fields=name&include=movies', '/actors/stats',
+                 '/actors/%d' % actor_ids[0], '/performances?total=exact'):
+        expected = wsgi.request('GET', path)
+        actual = asgi.request('GET', path)
+        assert (actual.status_code, actual.json) == (expected.status_code, expected.json), path
@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import event
+
+from conftest import WSGIClient
+
+
+'''
+Statement counts
+
+A listing reads a page, and the casts or castings of the whole page, in a
+fixed number of statements however many rows the page holds. Each test
+counts the statements of the same request with SIZE movies and actors in
+the database, and again with SCALE times as many.
+'''
+
+SIZE = 5
+SCALE = 4
+
+
+'''
+add_rows(client, n)
+Adds `n` movies and `n` actors, each actor cast in two of the new movies.
+'''
+def add_rows(client, n):
+    movie_ids = client.request('POST', '/movies/bulk', [
+        {'title': 'Movie %d' % i, 'release_date': '2020-01-01'} for i in range(n)]).json['ids']
+    actor_ids = client.request('POST', '/actors/bulk', [
+        {'name': 'Actor %d' % i, 'age': 30, 'gender': 'F'} for i in range(n)]).json['ids']
+    response = client.request('POST', '/performance/bulk', [
+        {'actor_id': actor_id, 'movie_id': movie_ids[(i + offset) % n]}
+        for i, actor_id in enumerate(actor_ids) for offset in (0, 1)])
+    assert response.status_code == 200
+
+
+def count_statements(wsgi_app, client, path, details_key):
+    from models import db
+
+    statements = []
+
+    def record(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    with wsgi_app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.request('GET', path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return len(statements), len(response.json[details_key])
+
+
+@pytest.mark.parametrize('read_model', [False, True])
+@pytest.mark.parametrize('path, details_key', [
+    ('/movies', 'movie_details'),
+    ('/movies?fields=title&include=actors', 'movie_details'),
+    ('/actors', 'actor_details'),
+    ('/actors?fields=name&include=movies', 'actor_details'),
+    ('/performances', 'performance_details')
+])
+def test_listing_statements_do_not_grow_with_rows(wsgi_app, reset, monkeypatch,
+                                                  read_model, path, details_key):
+    from config import settings
+
+    monkeypatch.setattr(settings, 'CASTING_READ_MODEL', read_model)
+    client = WSGIClient(wsgi_app)
+
+    add_rows(client, SIZE)
+    statements, rows = count_statements(wsgi_app, client, path, details_key)
+
+    add_rows(client, SIZE * (SCALE - 1))
+    scaled_statements, scaled_rows = count_statements(wsgi_app, client, path, details_key)
+
+    assert scaled_rows == SCALE * rows
+    assert scaled_statements == statements
@@ -0,0 +1,626 @@
+import sys
+from collections import namedtuple
+from functools import partial
+from sqlalchemy import DateTime, String, bindparam, cast, literal, select, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import abort
+
+from config import settings
+from models import Movie, Actor, Performance, CastingDetail, bump_versions
+from pagination import page_args, paginate, count_rows
+from filters import movie_filters, actor_filters, release_filters
+from stats import movie_stats, actor_stats
+from fieldsets import movie_fieldset, actor_fieldset, movie_options, actor_options, includes
+from bulk import (validate_all, validate_movie, validate_actor, validate_casting, bulk_insert,
+                  insert_castings, integrity_errors)
+from read_model import (record_castings, refresh_movie, refresh_actor, movie_casts,
+                        actor_castings, performances_query as read_model_performances)
+
+
+'''
+Views
+
+The bodies of the API routes, shared by the WSGI app (app.py) and the
+async one (asgi.py). Each is a plain function of a session and the parsed
+request: app.py calls it with db.session, asgi.py hands it to run_db().
+It returns (body, status code) and aborts with the documented status code
+on bad input.
+
+What depends on the framework stays in the apps: authentication,
+conditional GETs, the response cache, streaming and serialization.
+'''
+
+NOT_FOUND = {
+    'success': False,
+    'message': 'No records were found'
+}
+
+
+'''
+parse_id(value, status_code)
+`value` as an integer id, aborting with `status_code` when it is not one
+the id columns can hold.
+'''
+def parse_id(value, status_code):
+    try:
+        id = int(value)
+    except (TypeError, ValueError):
+        abort(status_code)
+    if not -2 ** 31 <= id < 2 ** 31:
+        abort(status_code)
+    return id
+
+
+'''
+sqlstate_class(error)
+The SQLSTATE class of a database error: '22' for a rejected value, '23'
+for a violated constraint. psycopg2 raises the first as DataError, asyncpg
+only as DBAPIError, so the views go by the code.
+'''
+def sqlstate_class(error):
+    return (getattr(error.orig, 'pgcode', None) or '')[:2]
+
+
+'''
+pg_timestamp(value)
+A timestamp column value PostgreSQL parses from the string `value`, so
+every input format it accepts, e.g. "January 01 2020", works the same on
+psycopg2 and asyncpg. Aborts with 400 when `value` is not a string.
+'''
+def pg_timestamp(value):
+    if not isinstance(value, str):
+        abort(400)
+    return cast(literal(value, String), DateTime)
+
+
+'''
+parse_release_dates(session, rows)
+Has PostgreSQL parse the release dates of validated movie rows in one
+query, as pg_timestamp() does for a single movie, and puts the timestamps
+in the rows. Returns the per-item errors of the dates it rejects, which
+are only looked for one by one when the query fails.
+'''
+RELEASE_DATES = text(
+    "SELECT CAST(d AS timestamp) FROM unnest(CAST(:dates AS text[])) "
+    "WITH ORDINALITY AS t(d, i) ORDER BY i"
+).bindparams(bindparam('dates', type_=ARRAY(String)))
+
+
+def parse_release_dates(session, rows):
+    dates = [row['release_date'] for row in rows]
+    try:
+        parsed = session.execute(RELEASE_DATES, {'dates': dates}).scalars().all()
+    except DBAPIError as e:
+        if sqlstate_class(e) != '22':
+            raise
+        session.rollback()
+        return [{'index': index, 'message': 'release_date is not a valid date.'}
+                for index, value in enumerate(dates) if not is_timestamp(session, value)]
+    for row, release_date in zip(rows, parsed):
+        row['release_date'] = release_date
+    return []
+
+
+def is_timestamp(session, value):
+    try:
+        session.execute(select(pg_timestamp(value)))
+    except DBAPIError as e:
+        if sqlstate_class(e) != '22':
+            raise
+        session.rollback()
+        return False
+    return True
+
+
+'''
+Listing(query, key, format_row, table, filters, related)
+How to read a listing: query(session) builds the query, `key` orders the
+pages, format_row shapes each row and `table` is counted for totals, with
+`filters`. `related`, when set, reads the casts or castings of a page from
+the read model and hands them to format_row.
+'''
+Listing = namedtuple('Listing', 'query key format_row table filters related',
+                     defaults=((), None))
+
+
+def format_performance(performance):
+    return {
+        'movie_id': performance.movie_id,
+        'movie_title': performance.title,
+        'movie_release_date': performance.release_date,
+        'actor_id': performance.actor_id,
+        'actor_name': performance.name,
+        'actor_age': performance.age,
+        'actor_gender': performance.gender
+    }
+
+
+'''
+performances_query(session)
+One join across performance, movies and actors, selecting only the
+serialized columns.
+'''
+def performances_query(session):
+    return session.query(
+        Performance.c.id,
+        Performance.c.movie_id,
+        Movie.title,
+        Movie.release_date,
+        Performance.c.actor_id,
+        Actor.name,
+        Actor.age,
+        Actor.gender
+    ).join(Movie, Movie.id == Performance.c.movie_id) \
+     .join(Actor, Actor.id == Performance.c.actor_id)
+
+
+'''
+movie_listing(args, paged=True) / actor_listing(args, paged=True)
+The Listing of GET /movies or GET /actors for the request `args`. Casts
+and castings come from the read model when it is on, unless the rows are
+not read a page at a time (`paged`), as when app.py streams them.
+'''
+def movie_listing(args, paged=True):
+    try:
+        filters = movie_filters(args)
+        fields, cast = movie_fieldset(args)
+    except ValueError:
+        abort(400)
+    read_model = cast and settings.CASTING_READ_MODEL and paged
+    return Listing(
+        lambda session: session.query(Movie).options(
+            *movie_options(fields, cast and not read_model)).filter(*filters),
+        Movie.id,
+        partial(Movie.format_listing, fields=fields, cast=cast),
+        Movie.__table__,
+        filters,
+        movie_casts if read_model else None
+    )
+
+
+def actor_listing(args, paged=True):
+    try:
+        filters = actor_filters(args)
+        fields, castings = actor_fieldset(args)
+    except ValueError:
+        abort(400)
+    read_model = castings and settings.CASTING_READ_MODEL and paged
+    return Listing(
+        lambda session: session.query(Actor).options(
+            *actor_options(fields, castings and not read_model)).filter(*filters),
+        Actor.id,
+        partial(Actor.format_listing, fields=fields, castings=castings),
+        Actor.__table__,
+        filters,
+        actor_castings if read_model else None
+    )
+
+
+def performance_listing():
+    if settings.CASTING_READ_MODEL:
+        # Already joined, ids are the performance ids
+        return Listing(
+            read_model_performances, CastingDetail.c.id, format_performance, Performance)
+    return Listing(
+        performances_query, Performance.c.id, format_performance, Performance)
+
+
+'''
+load_page(session, listing, limit, after_id, total)
+Returns (rows, next_cursor, count) for one page of a listing, the rows
+already formatted. count is None unless `total` asks for it. Casts or
+castings, when included, are loaded for the whole page in one extra query.
+'''
+def load_page(session, listing, limit, after_id, total=None):
+    rows, next_cursor = paginate(listing.query(session), listing.key, limit, after_id)
+    count = count_rows(session, listing.table, total, listing.filters) if total else None
+    format_row = listing.format_row
+    if listing.related is not None:
+        format_row = partial(
+            format_row, related=listing.related([row.id for row in rows], session))
+    return [format_row(row) for row in rows], next_cursor, count
+
+
+'''
+get_page(session, listing, args, details_key, total_key)
+A page of a collection route, read as `args` ask.
+'''
+def get_page(session, listing, args, details_key, total_key):
+    try:
+        limit, after_id, total = page_args(args)
+    except ValueError:
+        abort(400)
+
+    rows, next_cursor, count = load_page(session, listing, limit, after_id, total)
+    if len(rows) == 0 and after_id is None:
+        return NOT_FOUND, 404
+
+    body = {
+        "success": True,
+        details_key: rows,
+        "next_cursor": next_cursor
+    }
+    if total:
+        body[total_key] = count
+    return body, 200
+
+
+#  Movies
+#  ----------------------------------------------------------------
+
+
+def get_movie_stats(session, args):
+    try:
+        filters = movie_filters(args)
+    except ValueError:
+        abort(400)
+
+    # Totals, cast sizes and movies per year in one aggregate query
+    body = movie_stats(filters, session)
+    body['success'] = True
+    return body, 200
+
+
+def get_movie(session, movie_id, args):
+    try:
+        cast = includes(args, 'actors')
+    except ValueError:
+        abort(400)
+
+    query = session.query(Movie)
+    if cast and not settings.CASTING_READ_MODEL:
+        # The cast comes back in the same query as the movie
+        query = query.options(joinedload(Movie.actor))
+    movie = query.filter(Movie.id == parse_id(movie_id, 400)).first()
+    if movie is None:
+        abort(404)
+
+    body = {
+        "success": True,
+        "id": movie.id,
+        "movie": movie.title
+    }
+    if cast:
+        if settings.CASTING_READ_MODEL:
+            body["actors"] = movie_casts([movie.id], session).get(movie.id, [])
+        else:
+            body["actors"] = movie.format_cast()
+    return body, 200
+
+
+def create_movie(session, data):
+    try:
+        movie = Movie(title=data['title'], release_date=pg_timestamp(data['release_date']))
+    except (KeyError, TypeError):
+        abort(400)
+
+    try:
+        session.add(movie)
+        bump_versions('movies', session=session)
+        session.commit()
+
+    except DBAPIError as e:
+        if sqlstate_class(e) not in ('22', '23'):
+            raise
+        session.rollback()
+        print(sys.exc_info())
+        abort(400)
+
+    return {
+        "success": True,
+        "id": movie.id,
+        "title": movie.title
+    }, 200
+
+
+'''
+create_all(session, model, items, validate, parse)
+Validates every item, and has parse(session, rows) check what only the
+database can, then inserts them all in one transaction. Invalid items are
+reported with 400, and a batch the database rejects with 422,
+in the same per-item format.
+'''
+def create_all(session, model, items, validate, parse=None):
+    rows, errors = validate_all(items, validate)
+    if not errors and parse is not None:
+        errors = parse(session, rows)
+    if errors:
+        return {
+            "success": False,
+            "errors": errors
+        }, 400
+
+    try:
+        ids = bulk_insert(model.__table__, rows, session=session)
+        bump_versions(model.__tablename__, session=session)
+        session.commit()
+
+    except IntegrityError as e:
+        session.rollback()
+        print(sys.exc_info())
+        return {
+            "success": False,
+            "errors": integrity_errors(e, session=session)
+        }, 422
+
+    except DBAPIError as e:
+        if sqlstate_class(e) != '22':
+            raise
+        session.rollback()
+        print(sys.exc_info())
+        abort(400)
+
+    return {
+        "success": True,
+        "ids": ids,
+        "total": len(ids)
+    }, 200
+
+
+def create_movies_bulk(session, items):
+    return create_all(session, Movie, items, validate_movie, parse_release_dates)
+
+
+def delete_movie(session, movie_id):
+    movie = session.get(Movie, parse_id(movie_id, 404))
+    if movie is None:
+        abort(404)
+
+    session.delete(movie)
+    bump_versions('movies', 'performance', session=session)
+    session.commit()
+    return {
+        "success": True,
+        "movie": movie_id
+    }, 200
+
+
+def patch_movie(session, movie_id, data):
+    movie_id = parse_id(movie_id, 400)
+    if not isinstance(data, dict):
+        abort(400)
+    new_title = data.get("title", None)
+    new_release_date = data.get("release_date", None)
+
+    movie = session.get(Movie, movie_id)
+    if movie is None:
+        abort(404)
+
+    try:
+        if new_title:
+            movie.title = new_title
+        if new_release_date:
+            movie.release_date = pg_timestamp(new_release_date)
+        refresh_movie(movie.id, session=session)
+        bump_versions('movies', session=session)
+        session.commit()
+
+    except DBAPIError as e:
+        if sqlstate_class(e) not in ('22', '23'):
+            raise
+        session.rollback()
+        print(sys.exc_info())
+        abort(400)
+
+    return {
+        "success": True,
+        "movie": new_title,
+        "release_date": new_release_date
+    }, 200
+
+
+#  Actors
+#  ----------------------------------------------------------------
+
+
+def get_actor_stats(session, args):
+    try:
+        filters = actor_filters(args)
+        castings_filters = release_filters(args)
+    except ValueError:
+        abort(400)
+
+    # Totals, castings per actor, gender and age breakdowns in one
+    # aggregate query
+    body = actor_stats(filters, castings_filters, session)
+    body['success'] = True
+    return body, 200
+
+
+def get_actor(session, actor_id, args):
+    try:
+        castings = includes(args, 'movies')
+    except ValueError:
+        abort(400)
+
+    query = session.query(Actor)
+    if castings and not settings.CASTING_READ_MODEL:
+        # The castings come back in the same query as the actor
+        query = query.options(joinedload(Actor.movies))
+    actor = query.filter(Actor.id == parse_id(actor_id, 404)).first()
+    if actor is None:
+        abort(404)
+
+    body = {
+        "success": True,
+        "id": actor.id,
+        "actor": actor.name
+    }
+    if castings:
+        if settings.CASTING_READ_MODEL:
+            body["movies"] = actor_castings([actor.id], session).get(actor.id, [])
+        else:
+            body["movies"] = actor.format_castings()
+    return body, 200
+
+
+def create_actor(session, data):
+    try:
+        actor = Actor(name=data['name'], age=int(data['age']), gender=data['gender'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    try:
+        session.add(actor)
+        bump_versions('actors', session=session)
+        session.commit()
+
+    except DBAPIError as e:
+        if sqlstate_class(e) not in ('22', '23'):
+            raise
+        session.rollback()
+        print(sys.exc_info())
+        abort(400)
+
+    return {
+        "success": True,
+        "id": actor.id,
+        "name": actor.name
+    }, 200
+
+
+def create_actors_bulk(session, items):
+    return create_all(session, Actor, items, validate_actor)
+
+
+def delete_actor(session, actor_id):
+    actor = session.get(Actor, parse_id(actor_id, 404))
+    if actor is None:
+        abort(404)
+
+    session.delete(actor)
+    bump_versions('actors', 'performance', session=session)
+    session.commit()
+    return {
+        "success": True,
+        "actor": actor_id
+    }, 200
+
+
+def patch_actor(session, actor_id, data):
+    actor_id = parse_id(actor_id, 404)
+    if not isinstance(data, dict):
+        abort(400)
+
+    actor = session.get(Actor, actor_id)
+    if actor is None:
+        abort(404)
+
+    try:
+        new_name = data.get("name", None)
+        new_age = data.get("age", None)
+        new_gender = data.get("gender", None)
+        if new_name:
+            actor.name = new_name
+        if new_age:
+            actor.age = int(new_age)
+        if new_gender:
+            actor.gender = new_gender
+        refresh_actor(actor.id, session=session)
+        bump_versions('actors', session=session)
+        session.commit()
+
+    except Exception as e:
+        session.rollback()
+        print(e)
+        abort(422)
+
+    return {
+        "success": True,
+        "name": actor.name,
+        "age": actor.age,
+        "gender": actor.gender
+    }, 200
+
+
+#  Perfermance
+#  ----------------------------------------------------------------
+
+
+def create_performance(session, data):
+    try:
+        actor_id, movie_id = validate_casting(data)
+    except ValueError:
+        abort(400)
+
+    try:
+        # One round trip, the unique constraint decides whether it existed
+        created = insert_castings([(actor_id, movie_id)], session=session)
+        if created:
+            record_castings(created, session=session)
+            bump_versions('performance', session=session)
+        session.commit()
+
+    except IntegrityError:
+        session.rollback()
+        print(sys.exc_info())
+        abort(422)
+
+    except DBAPIError as e:
+        if sqlstate_class(e) != '22':
+            raise
+        session.rollback()
+        print(sys.exc_info())
+        abort(400)
+
+    if not created:
+        return {
+            "success": False,
+            "message": "There is a performance with this actor and movie already.",
+        }, 400
+
+    return {
+        "success": True,
+        "actor_id": actor_id,
+        "movie_id": movie_id
+    }, 200
+
+
+def create_performances_bulk(session, items):
+    pairs, errors = validate_all(items, validate_casting)
+    if errors:
+        return {
+            "success": False,
+            "errors": errors
+        }, 400
+
+    try:
+        created = insert_castings(pairs, session=session)
+        if created:
+            record_castings(created, session=session)
+            bump_versions('performance', session=session)
+        session.commit()
+
+    except IntegrityError as e:
+        session.rollback()
+        print(sys.exc_info())
+        return {
+            "success": False,
+            "errors": integrity_errors(e, pairs, session=session)
+        }, 422
+
+    except DBAPIError as e:
+        if sqlstate_class(e) != '22':
+            raise
+        session.rollback()
+        print(sys.exc_info())
+        abort(400)
+
+    # Only the first occurrence of a pair repeated in the request counts
+    # as created
+    castings = []
+    for actor_id, movie_id in pairs:
+        castings.append({
+            "actor_id": actor_id,
+            "movie_id": movie_id,
+            "created": (actor_id, movie_id) in created
+        })
+        created.discard((actor_id, movie_id))
+
+    return {
+        "success": True,
+        "castings": castings,
+        "total_created": sum(1 for x in castings if x["created"])
+    }, 200